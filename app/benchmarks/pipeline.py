@@ -0,0 +1,241 @@
+"""
+  Benchmark of the report pipeline, stage by stage. Run from the app/ directory:
+
+    python -m benchmarks.pipeline --sizes 1000 10000 100000
+    python -m benchmarks.pipeline --save-baseline
+    python -m benchmarks.pipeline --baseline benchmarks/baseline.json --threshold 0.1
+
+  Persistence runs against DB_SQLALCHEMY_DATABASE_URL, a temporary SQLite file unless set.
+  Against PostgreSQL the schema must already exist, the benchmark datasets are deleted afterwards
+"""
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("DB_SQLALCHEMY_DATABASE_URL", "sqlite:///" + os.path.join(tempfile.gettempdir(), "garmentwise-benchmark.db"))
+
+import numpy as np
+import pandas as pd
+from database import database
+from schemas.category import Category
+from schemas.dataset import Dataset
+from schemas.review import Review
+from schemas.review_categories import review_categories
+from schemas.review_text import ReviewText
+from sentiment_analysis import engine, preprocessing
+from sentiment_analysis.pickles.pickles import registry
+from sentiment_analysis.word_statistics import WordStatistics
+from services import dashboard_service as dashboard
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SEED_DATASET = os.path.join(BENCHMARKS_DIR, '..', '..', 'datasets', 'Womens Clothing E-Commerce Reviews 1000.csv')
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_THRESHOLD = 0.1
+
+CATEGORY_MODELS = [('fit', 'FIT'), ('color', 'COLOR'), ('quality', 'QUALITY')]
+
+def synthesize_corpus(size: int, seed: int = 0):
+  """
+    Builds a corpus of the given size from the sentences of the seed dataset, so that
+    texts repeat about as often as in real uploads instead of being exact copies
+  """
+  rng = np.random.default_rng(seed)
+  seed_reviews = pd.read_csv(SEED_DATASET)['reviewText'].dropna()
+  sentences = [sentence.strip() for review in seed_reviews for sentence in review.split('.') if sentence.strip()]
+  lengths = rng.integers(1, 6, size=size)
+  picks = rng.integers(0, len(sentences), size=int(lengths.sum()))
+  reviews = []
+  position = 0
+  for length in lengths:
+    reviews.append('. '.join(sentences[index] for index in picks[position:position + length]) + '.')
+    position += length
+  return pd.DataFrame({'reviewText': reviews, 'rating': rng.integers(1, 6, size=size)})
+
+def peak_rss_mb():
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Reported in bytes on macOS and in kilobytes elsewhere
+  return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+class StageTimer:
+  def __init__(self, rows: int):
+    self.rows = rows
+    self.stages = {}
+
+  def run(self, stage: str, function, *args, **kwargs):
+    gc.collect()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    self.stages[stage] = {'seconds': elapsed, 'rows_per_second': self.rows / elapsed if elapsed > 0 else None}
+    return result
+
+def _prepare_database():
+  if database.engine.dialect.name == 'sqlite':
+    # The report tables use PostgreSQL types, the reviews do not need them
+    tables = [Category.__table__, Dataset.__table__, ReviewText.__table__, Review.__table__, review_categories]
+    database.Base.metadata.create_all(database.engine, tables=tables)
+
+def _persist(reviews_list: list, db):
+  dataset = dashboard.save_dataset(report=None, report_metadata={'dataset_title': 'benchmark'}, db=db)
+  dashboard.save_reviews_bulk(dataset=dataset, reviews_list=reviews_list, db=db)
+  return dataset
+
+def _score(counts, prediction_type: str, category_masks: np.ndarray, category: str = None):
+  vectorizer = engine.get_shared_vectorizer()
+  model, model_vectorizer = registry.model('general' if category is None else prediction_type)
+  rows = None
+  if category is not None:
+    rows = (category_masks & database.DB_CATEGORY_BITS[category]) != 0
+    if not rows.any():
+      return None
+  return model.predict(vectorizer.transform(counts, model_vectorizer, rows=rows))
+
+def run_pipeline(corpus: pd.DataFrame, persist: bool = True):
+  """
+    Runs every stage of the pipeline over a corpus, timing each one on its own
+  """
+  timer = StageTimer(rows=corpus.shape[0])
+  preprocessing.review_tokens.cache_clear()
+  preprocessing._normalize_token.cache_clear()
+
+  csv_file = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+  try:
+    corpus.to_csv(csv_file.name, index=False)
+    df = timer.run('read_csv', pd.read_csv, csv_file.name)
+  finally:
+    csv_file.close()
+    os.remove(csv_file.name)
+
+  reviews = df['reviewText'].fillna('')
+  tokens, preprocessed = timer.run('clean_review', preprocessing.preprocess_reviews, reviews)
+  category_masks = timer.run('classify_review', engine.get_keyword_index().classify_reviews, tokens)
+  counts = timer.run('vectorize', engine.get_shared_vectorizer().count, preprocessed)
+  timer.run('score_overall', _score, counts, 'overall', category_masks)
+  for prediction_type, category in CATEGORY_MODELS:
+    timer.run(f'score_{prediction_type}', _score, counts, prediction_type, category_masks, category)
+
+  # The remaining stages need the frame the engine builds, which is not timed again
+  df = engine.process_frame(df)
+  statistics = WordStatistics()
+  timer.run('word_count', statistics.update, df)
+  timer.run('wordcloud', engine.render_wordcloud, statistics.frequencies())
+
+  if persist:
+    reviews_list = engine.reviews_records(df)
+    db = database.SessionLocal()
+    try:
+      dataset = timer.run('persist_reviews', _persist, reviews_list, db)
+      dashboard.delete_dataset(dataset_id=dataset.id, db=db)
+    finally:
+      db.close()
+
+  return timer.stages
+
+def measure_size(size: int, seed: int = 0, repeat: int = 1, persist: bool = True):
+  """
+    Benchmarks one corpus size. Meant to run in a process of its own, whose peak memory
+    then only covers the models and this size
+  """
+  for name in ['general', 'fit', 'color', 'quality']:
+    registry.model(name)
+  engine.get_keyword_index()
+  engine.get_shared_vectorizer()
+  if persist:
+    _prepare_database()
+  models_rss_mb = peak_rss_mb()
+
+  corpus = synthesize_corpus(size, seed=seed)
+  runs = [run_pipeline(corpus, persist=persist) for _ in range(repeat)]
+  # The fastest run is the least disturbed by the rest of the machine
+  stages = {stage: min((run[stage] for run in runs), key=lambda timing: timing['seconds']) for stage in runs[0]}
+  peak = peak_rss_mb()
+  return {
+    'stages': stages,
+    'peak_rss_mb': peak,
+    # Memory the pipeline needed on top of the loaded models
+    'pipeline_rss_mb': peak - models_rss_mb,
+    'model_format': registry.model_format,
+    'model_load_seconds': dict(registry.load_times)
+  }
+
+def run_benchmark(sizes: list, seed: int = 0, repeat: int = 1, persist: bool = True):
+  # The peak RSS of a process never goes down, so every size gets a fresh one
+  context = multiprocessing.get_context('spawn')
+  results = {}
+  for size in sizes:
+    with context.Pool(processes=1) as pool:
+      results[str(size)] = pool.apply(measure_size, (size, seed, repeat, persist))
+  # Every process loads the same models, the first one's load times stand for all
+  model_format = [result.pop('model_format') for result in results.values()][0]
+  model_load_seconds = [result.pop('model_load_seconds') for result in results.values()][0]
+  return {
+    'python': platform.python_version(),
+    'database': database.engine.dialect.name,
+    'model_format': model_format,
+    'model_load_seconds': model_load_seconds,
+    'results': results
+  }
+
+def compare(current: dict, baseline: dict, threshold: float = DEFAULT_THRESHOLD):
+  """
+    Lists the stages that got slower than the baseline by more than the threshold
+  """
+  regressions = []
+  for size, result in current['results'].items():
+    baseline_stages = baseline['results'].get(size, {}).get('stages', {})
+    for stage, timing in result['stages'].items():
+      if stage not in baseline_stages:
+        continue
+      previous = baseline_stages[stage]['seconds']
+      if timing['seconds'] > previous * (1 + threshold):
+        regressions.append({'size': size, 'stage': stage, 'baseline': previous, 'current': timing['seconds'],
+                            'change': timing['seconds'] / previous - 1})
+  return regressions
+
+def print_report(current: dict, regressions: list):
+  for size, result in current['results'].items():
+    print(f"{size} reviews, peak RSS {result['peak_rss_mb']:.0f} MB, {result['pipeline_rss_mb']:.0f} MB above the loaded models")
+    for stage, timing in result['stages'].items():
+      throughput = f"{timing['rows_per_second']:>14,.0f} rows/s" if timing['rows_per_second'] else ''
+      print(f"  {stage:<16} {timing['seconds']:>9.3f}s {throughput}")
+  for regression in regressions:
+    print(f"REGRESSION {regression['size']} {regression['stage']}: {regression['baseline']:.3f}s -> "
+          f"{regression['current']:.3f}s ({regression['change']:+.0%})")
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmarks the sentiment pipeline stage by stage")
+  parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--repeat', type=int, default=1)
+  parser.add_argument('--no-persist', action='store_true', help="skip the database stage")
+  parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+  parser.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+  parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="allowed slowdown, 0.1 being 10%%")
+  parser.add_argument('--output', help="also write the results to this JSON file")
+  args = parser.parse_args(argv)
+
+  current = run_benchmark(args.sizes, seed=args.seed, repeat=args.repeat, persist=not args.no_persist)
+  regressions = []
+  if not args.save_baseline and os.path.exists(args.baseline):
+    with open(args.baseline) as file:
+      regressions = compare(current, json.load(file), threshold=args.threshold)
+  print_report(current, regressions)
+
+  if args.output:
+    with open(args.output, 'w') as file:
+      json.dump(current, file, indent=2)
+  if args.save_baseline:
+    with open(args.baseline, 'w') as file:
+      json.dump(current, file, indent=2)
+  return 1 if regressions else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,7 +1,8 @@
 from dotenv import load_dotenv
 import os
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -12,13 +13,68 @@ DB_CATEGORY_CODES = {
     'QUALITY': 3,
     'OTHER': 4
 }
+# Bits of the category bitmask of a review, OTHER being the empty mask
+DB_CATEGORY_BITS = {
+    'FIT': 1,
+    'COLOR': 2,
+    'QUALITY': 4
+}
+# Value of a review's prediction for each sentiment
+DB_SENTIMENT_VALUES = {
+    'negative': 0,
+    'positive': 1
+}
 
 load_dotenv()
 
-engine = create_engine(os.getenv("DB_SQLALCHEMY_DATABASE_URL"))
+DB_BULK_BATCH_SIZE = int(os.getenv("DB_BULK_BATCH_SIZE", 1000))
+# 'compact' stores the categories of a review as a bitmask, unscored categories as NULL and each distinct text once
+DB_REVIEW_STORAGE = os.getenv("DB_REVIEW_STORAGE", "legacy")
+DB_SQLALCHEMY_DATABASE_URL = os.getenv("DB_SQLALCHEMY_DATABASE_URL")
+DB_ASYNC_SQLALCHEMY_DATABASE_URL = os.getenv("DB_ASYNC_SQLALCHEMY_DATABASE_URL")
+# Hosting providers hand out postgres:// URLs, a scheme SQLAlchemy no longer accepts
+if DB_SQLALCHEMY_DATABASE_URL.startswith("postgres://"):
+  DB_SQLALCHEMY_DATABASE_URL = DB_SQLALCHEMY_DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+def async_database_url(database_url: str):
+  """
+    Returns the asyncpg URL of a PostgreSQL database whatever its synchronous driver, None for other databases
+  """
+  url = make_url(database_url)
+  if url.get_backend_name() != 'postgresql':
+    return None
+  return url.set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
+
+if DB_ASYNC_SQLALCHEMY_DATABASE_URL is None:
+  DB_ASYNC_SQLALCHEMY_DATABASE_URL = async_database_url(DB_SQLALCHEMY_DATABASE_URL)
+
+DB_POOL_OPTIONS = {
+  "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+  "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+  "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+  "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+  "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+}
+
+engine = create_engine(DB_SQLALCHEMY_DATABASE_URL, **DB_POOL_OPTIONS)
 Base = declarative_base()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine used by the API handlers, the worker processes keep using the synchronous one
+async_engine = None
+AsyncSessionLocal = None
+if DB_ASYNC_SQLALCHEMY_DATABASE_URL is not None:
+  async_engine = create_async_engine(DB_ASYNC_SQLALCHEMY_DATABASE_URL, **DB_POOL_OPTIONS)
+  AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+def check_async_engine():
+  """
+    Fails at startup when the API handlers would have no database to use
+  """
+  if async_engine is None:
+    raise RuntimeError("No async database URL could be derived from DB_SQLALCHEMY_DATABASE_URL, "
+                       "set DB_ASYNC_SQLALCHEMY_DATABASE_URL to an async driver URL such as postgresql+asyncpg://")
+
 def init_db():
   Base.metadata.create_all(engine)
 
@@ -27,4 +83,8 @@ def get_db():
     db = SessionLocal()
     yield db
   finally:
-    db.close()
\ No newline at end of file
+    db.close()
+
+async def get_async_db():
+  async with AsyncSessionLocal() as db:
+    yield db
\ No newline at end of file
@@ -0,0 +1,47 @@
+"""
+  Brings a database created by an earlier version of the server up to the current schema.
+  Run from the app/ directory:
+
+    python -m database.upgrade
+
+  Every step is idempotent, running it again on an up to date database changes nothing
+"""
+from sqlalchemy import inspect, text
+from database.database import Base, SessionLocal, engine
+# Every table has to be registered on the metadata before create_all
+from schemas import category, dataset, job, report, report_group, report_rollup, review, review_categories, review_text, user, wordcloud_image  # noqa: F401
+from services import rollup_service as rollups
+
+# Columns and indexes added to tables that already existed, create_all only creates missing tables
+UPGRADE_STATEMENTS = [
+  "ALTER TABLE reports ADD COLUMN IF NOT EXISTS word_frequencies JSONB",
+  "ALTER TABLE reports ADD COLUMN IF NOT EXISTS word_statistics JSONB",
+  "ALTER TABLE reports ADD COLUMN IF NOT EXISTS next_review_number INTEGER",
+  "ALTER TABLE reviews ADD COLUMN IF NOT EXISTS category_mask SMALLINT",
+  "ALTER TABLE reviews ADD COLUMN IF NOT EXISTS text_id INTEGER REFERENCES review_texts (id)",
+  "ALTER TABLE reviews ALTER COLUMN prediction TYPE SMALLINT, ALTER COLUMN fit_score TYPE SMALLINT, "
+  "ALTER COLUMN color_score TYPE SMALLINT, ALTER COLUMN quality_score TYPE SMALLINT",
+  "CREATE INDEX IF NOT EXISTS ix_reports_user_id ON reports (user_id)",
+  "CREATE INDEX IF NOT EXISTS ix_reports_report_group_id ON reports (report_group_id)",
+  "CREATE INDEX IF NOT EXISTS ix_report_groups_user_id ON report_groups (user_id)",
+  "CREATE INDEX IF NOT EXISTS ix_review_categories_review_id ON review_categories (review_id)",
+  "CREATE INDEX IF NOT EXISTS ix_reviews_dataset_id_review_number ON reviews (dataset_id, review_number)",
+]
+
+def upgrade_database():
+  # Reports stored before the rollups existed are only counted once the rollups are rebuilt
+  had_rollups = inspect(engine).has_table(report_rollup.UserRollup.__tablename__)
+  Base.metadata.create_all(engine)
+  with engine.begin() as connection:
+    for statement in UPGRADE_STATEMENTS:
+      connection.execute(text(statement))
+
+  if not had_rollups:
+    db = SessionLocal()
+    try:
+      rollups.rebuild_rollups(db)
+    finally:
+      db.close()
+
+if __name__ == '__main__':
+  upgrade_database()
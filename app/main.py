@@ -1,24 +1,75 @@
-from fastapi import FastAPI
+import os
+import time
+from brotli_asgi import BrotliMiddleware
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from routers import auth, dashboard
+from fastapi.responses import ORJSONResponse
+from routers import auth, dashboard, scoring, metrics as metrics_router
+from services import job_service, scoring_service
+from database.database import async_engine, check_async_engine, engine
+from monitoring import metrics
+
+check_async_engine()
 
 app = FastAPI(
   title="GarmentWise",
   description="This API allows users to get insights on their clothing reviews",
-  version="1.0.0"
+  version="1.0.0",
+  default_response_class=ORJSONResponse
 )
 
+# Responses smaller than this are sent uncompressed, compressing them costs more than it saves
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", 1024))
+
+@app.on_event("shutdown")
+def shutdown_job_workers():
+  job_service.shutdown_executor()
+
+@app.on_event("shutdown")
+async def stop_scoring():
+  await scoring_service.batcher.close()
+  scoring_service.shutdown_executor()
+
+@app.on_event("shutdown")
+async def dispose_async_engine():
+  await async_engine.dispose()
+
+metrics.count_queries(engine, 'sync')
+metrics.count_queries(async_engine.sync_engine, 'async')
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+  request_metrics, token = metrics.start_request()
+  start = time.perf_counter()
+  status = 500
+  try:
+    response = await call_next(request)
+    status = response.status_code
+    return response
+  finally:
+    # Labelled by the route template so /reports/1 and /reports/2 share a series
+    route = request.scope.get('route')
+    route_path = route.path if route is not None else 'unmatched'
+    metrics.observe_request(request.method, route_path, status, time.perf_counter() - start, request_metrics)
+    metrics.end_request(token)
+
 app.include_router(auth.router, prefix="/auth")
 app.include_router(dashboard.router, prefix="/dashboard")
+app.include_router(scoring.router, prefix="/scoring")
+app.include_router(metrics_router.router)
 
 origins = [
     "http://localhost:4200"
 ]
 
+# Brotli for the clients that accept it, gzip for the rest
+app.add_middleware(BrotliMiddleware, minimum_size=COMPRESSION_MIN_BYTES, gzip_fallback=True)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
\ No newline at end of file
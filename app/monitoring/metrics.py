@@ -0,0 +1,111 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import inspect
+import logging
+import os
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Requests slower than this are logged with their stage breakdown, unset to disable the log
+SLOW_REQUEST_SECONDS = os.getenv("SLOW_REQUEST_SECONDS")
+SLOW_REQUEST_SECONDS = float(SLOW_REQUEST_SECONDS) if SLOW_REQUEST_SECONDS else None
+# When set, the report workers write their metrics there and /metrics aggregates every process
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+stage_seconds = Histogram('garmentwise_stage_seconds', 'Time spent in each pipeline and persistence stage',
+                          ['stage'], buckets=STAGE_BUCKETS)
+request_seconds = Histogram('garmentwise_request_seconds', 'Latency of the HTTP requests per route',
+                            ['method', 'route', 'status'], buckets=STAGE_BUCKETS)
+request_queries = Histogram('garmentwise_request_db_queries', 'Database queries issued per HTTP request',
+                            ['method', 'route'], buckets=QUERY_BUCKETS)
+db_queries = Counter('garmentwise_db_queries', 'Database queries issued', ['engine'])
+
+class RequestMetrics:
+  """
+    Stage timings and query count of the request being served
+  """
+  def __init__(self):
+    self.stages = {}
+    self.queries = 0
+
+  def add_stage(self, stage: str, seconds: float):
+    self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+_request_metrics: ContextVar = ContextVar('request_metrics', default=None)
+
+def start_request():
+  metrics = RequestMetrics()
+  return metrics, _request_metrics.set(metrics)
+
+def end_request(token):
+  _request_metrics.reset(token)
+
+def record_stage(stage: str, seconds: float):
+  stage_seconds.labels(stage=stage).observe(seconds)
+  metrics = _request_metrics.get()
+  if metrics is not None:
+    metrics.add_stage(stage, seconds)
+
+@contextmanager
+def timed(stage: str):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    record_stage(stage, time.perf_counter() - start)
+
+def instrument(stage: str):
+  """
+    Decorator that records the duration of every call of a function, sync or async
+  """
+  def decorator(function):
+    if inspect.iscoroutinefunction(function):
+      @functools.wraps(function)
+      async def async_wrapper(*args, **kwargs):
+        with timed(stage):
+          return await function(*args, **kwargs)
+      return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with timed(stage):
+        return function(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def count_queries(engine, name: str):
+  """
+    Counts the statements an engine executes, globally and for the request that issued them
+  """
+  @event.listens_for(engine, 'before_cursor_execute')
+  def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    db_queries.labels(engine=name).inc()
+    metrics = _request_metrics.get()
+    if metrics is not None:
+      metrics.queries += 1
+
+def observe_request(method: str, route: str, status: int, seconds: float, metrics: RequestMetrics):
+  request_seconds.labels(method=method, route=route, status=status).observe(seconds)
+  request_queries.labels(method=method, route=route).observe(metrics.queries)
+  if SLOW_REQUEST_SECONDS is not None and seconds >= SLOW_REQUEST_SECONDS:
+    breakdown = ', '.join(f'{stage}={stage_time:.3f}s' for stage, stage_time in sorted(metrics.stages.items(), key=lambda item: -item[1]))
+    logger.warning("Slow request %s %s took %.3fs with %d queries: %s", method, route, seconds, metrics.queries, breakdown or 'no stages')
+
+def render_metrics():
+  """
+    Returns the metrics in the Prometheus text format and its content type
+  """
+  if PROMETHEUS_MULTIPROC_DIR:
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+  else:
+    registry = REGISTRY
+  return generate_latest(registry), CONTENT_TYPE_LATEST
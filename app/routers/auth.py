@@ -1,28 +1,19 @@
 from datetime import timedelta, datetime
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from schemas.user import User
-from database.database import get_db
+from database.database import get_async_db
 
 from services.auth_service import ACCESS_TOKEN_EXPIRE_MINUTES
-from services.auth_service import user_exists, authenticate_user, create_access_token
+from services.auth_service import user_exists, authenticate_user, create_access_token, hash_password
 
 router = APIRouter()
 
-@router.post("/login", tags=["Authentication"])
-async def login(db: Session = Depends(get_db), form_data: OAuth2PasswordRequestForm = Depends()):
-  user = authenticate_user(email=form_data.username, password=form_data.password)
-  if not user:
-    raise HTTPException(
-      status_code=status.HTTP_401_UNAUTHORIZED,
-      detail="Invalid email or password",
-      headers={"WWW-Authenticate": "Bearer"},
-    )
-
+def token_response(user: User):
   access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
   access_token = create_access_token(
-    data={"sub": user.email}, expires_delta=access_token_expires
+    data={"sub": user.email, "uid": user.id}, expires_delta=access_token_expires
   )
 
   response = {
@@ -32,11 +23,23 @@ async def login(db: Session = Depends(get_db), form_data: OAuth2PasswordRequestF
   }
   return response
 
+@router.post("/login", tags=["Authentication"])
+async def login(db: AsyncSession = Depends(get_async_db), form_data: OAuth2PasswordRequestForm = Depends()):
+  user = await authenticate_user(email=form_data.username, password=form_data.password, db=db)
+  if not user:
+    raise HTTPException(
+      status_code=status.HTTP_401_UNAUTHORIZED,
+      detail="Invalid email or password",
+      headers={"WWW-Authenticate": "Bearer"},
+    )
+
+  return token_response(user)
+
 @router.post("/signup", tags=["Authentication"])
-async def signup(db: Session = Depends(get_db), form_data: OAuth2PasswordRequestForm = Depends()):
-  if user_exists(email=form_data.username, db=db):
+async def signup(db: AsyncSession = Depends(get_async_db), form_data: OAuth2PasswordRequestForm = Depends()):
+  if await user_exists(email=form_data.username, db=db):
     raise HTTPException(status_code=400, detail="Email address is already registered")
 
-  user = User.create(db, email=form_data.username, password=form_data.password)
-  response = await login(db, form_data)
-  return response
\ No newline at end of file
+  hashed_password = await hash_password(form_data.password)
+  user = await User.create(db, email=form_data.username, hashed_password=hashed_password)
+  return token_response(user)
\ No newline at end of file
@@ -1,164 +1,230 @@
-from datetime import datetime
-import json
-from typing import Annotated
-from fastapi import APIRouter, Depends, Form, HTTPException, Query, Request, UploadFile
-from database.database import get_db
-from database.database import SessionLocal
+from base64 import b64encode
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+from typing import Annotated, List, Optional
+from fastapi import APIRouter, Depends, Form, Header, HTTPException, Query, Request, Response, UploadFile
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import get_async_db
 from services.auth_service import get_current_user
+from services.authorization_service import authorize_collection, authorize_report, authorize_report_row, check_report_access, owns_collection
 from schemas.user import User
-from sentiment_analysis import engine
+from schemas.report import Report
+from schemas.report_group import ReportGroup
+from schemas.review import Review
+from schemas.job import JOB_KINDS
 from services import dashboard_service as dashboard
+from services import export_service as exports
+from services import job_service as jobs
+from services import rollup_service as rollups
+from services import wordcloud_service as wordclouds
 
 router = APIRouter()
 
-@router.get("/collections", tags=["Dashboard"])
-async def get_collections_by_user(current_user: User = Depends(get_current_user), db: SessionLocal = Depends(get_db)):
+@router.get("/collections", response_model=List[ReportGroup.ReportGroupResponse], tags=["Dashboard"])
+async def get_collections_by_user(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
   user_id = current_user.id
-  collections = dashboard.get_collections_by_user(user_id=user_id, db=db)
+  collections = await dashboard.get_collections_by_user(user_id=user_id, db=db)
   return collections
 
-@router.post("/collections/create", tags=["Dashboard"])
-async def create_collection(request: Request, current_user: User = Depends(get_current_user), db: SessionLocal = Depends(get_db)):
+@router.post("/collections/create", response_model=ReportGroup.ReportGroupResponse, tags=["Dashboard"])
+async def create_collection(request: Request, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
   data = await request.json()
   collection_name = data.get("collection_name")
-  collection = dashboard.save_collection(collection_name=collection_name, user=current_user, db=db)
+  collection = await dashboard.save_collection(collection_name=collection_name, user=current_user, db=db)
   return collection
 
-@router.get("/collections/{collection_id}", tags=["Dashboard"])
-async def get_collection(collection_id: int, current_user: User = Depends(get_current_user), db: SessionLocal = Depends(get_db)):
-  user_id = current_user.id
-  collections = dashboard.get_collection(collection_id=collection_id, db=db)
-  return collections
-
-@router.get("/collections/{collection_id}/reports", tags=["Dashboard"])
-async def get_reports_by_collection(collection_id: int, current_user: User = Depends(get_current_user), db: SessionLocal = Depends(get_db)):
-  collections = dashboard.get_collections_by_user(user_id=current_user.id, db=db)
-
-  if int(collection_id) not in [collection.id for collection in collections]:
-    raise HTTPException(status_code=403, detail="Unauthorized to access this collection's reports.")
+@router.get("/collections/{collection_id}", response_model=ReportGroup.ReportGroupResponse, tags=["Dashboard"])
+async def get_collection(collection_id: int, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+  collection = await dashboard.get_collection(collection_id=collection_id, user_id=current_user.id, db=db)
+  if collection is None:
+    raise HTTPException(status_code=404, detail="Collection not found")
+  return collection
 
-  reports = dashboard.get_reports_by_collection(report_group_id=collection_id, db=db)
+@router.get("/collections/{collection_id}/reports", response_model=List[Report.ReportSummary], tags=["Dashboard"])
+async def get_reports_by_collection(collection_id: int = Depends(authorize_collection), db: AsyncSession = Depends(get_async_db)):
+  reports = await dashboard.get_reports_by_collection(report_group_id=collection_id, db=db)
   return reports
 
-@router.post("/reports/create", tags=["Dashboard"])
+@router.get("/collections/{collection_id}/rollup", tags=["Dashboard"])
+async def get_collection_rollup(collection_id: int = Depends(authorize_collection), db: AsyncSession = Depends(get_async_db)):
+  rollup = await rollups.get_collection_rollup(collection_id=collection_id, db=db)
+  return rollup
+
+@router.get("/rollup", tags=["Dashboard"])
+async def get_user_rollup(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+  rollup = await rollups.get_user_rollup(user_id=current_user.id, db=db)
+  return rollup
+
+@router.get("/rollup/daily", tags=["Dashboard"])
+async def get_user_daily_rollups(start: Optional[date] = None,
+                                 end: Optional[date] = None,
+                                 current_user: User = Depends(get_current_user),
+                                 db: AsyncSession = Depends(get_async_db)):
+  daily_rollups = await rollups.get_user_daily_rollups(user_id=current_user.id, db=db, start=start, end=end)
+  return daily_rollups
+
+@router.post("/reports/create", status_code=202, tags=["Dashboard"])
 async def create_report(report_name: Annotated[str, Form()], 
                         collection_id: Annotated[str, Form()], 
                         file: UploadFile,
                         current_user: User=Depends(get_current_user), 
-                        db: SessionLocal=Depends(get_db)):
+                        db: AsyncSession=Depends(get_async_db)):
   
-  collections = dashboard.get_collections_by_user(user_id=current_user.id, db=db)
-  ids = [collection.id for collection in collections]
-  if int(collection_id) not in ids:
+  if not await owns_collection(collection_id=int(collection_id), user_id=current_user.id, db=db):
     raise HTTPException(status_code=403, detail="Unauthorized to create a report in this collection.")
-    
-  results, metadata, reviews, word_count, wordcloud = engine.predict(file)
-
-  report_data = {
-      "title": report_name,
-      "user_id": current_user.id,
-      "report_group_id": collection_id,
-      "date": datetime.now(),
-      **results['scores'],
-      **results['number_of_reviews'],
-      "word_count": json.dumps(word_count),
-      "wordcloud": wordcloud,
+
+  upload_path = await run_in_threadpool(jobs.spool_upload, file)
+  job = await jobs.create_job(title=report_name, filename=file.filename, collection_id=int(collection_id), user=current_user, db=db)
+  try:
+    jobs.submit_report_job(job=job, upload_path=upload_path)
+  except BrokenProcessPool:
+    raise HTTPException(status_code=503, detail="Report workers are unavailable, please try again later.")
+
+  response = {
+    "job_id": job.id,
+    "status": job.status,
   }
-    
-  report = dashboard.save_report(report_data=report_data, db=db)
-  
-  def save_dataset(report):
-    dataset = dashboard.save_dataset(report=report, report_metadata=metadata, db=db)
-    reviews_categories = dashboard.save_reviews(dataset=dataset, reviews_list=reviews, db=db)
-    dashboard.save_review_categories(reviews_categories_list=reviews_categories, db=db)
+  return response
 
-  save_dataset(report)
+@router.post("/reports/{report_id}/append", status_code=202, tags=["Dashboard"])
+async def append_to_report(file: UploadFile,
+                           report=Depends(authorize_report_row),
+                           current_user: User=Depends(get_current_user),
+                           db: AsyncSession=Depends(get_async_db)):
+  upload_path = await run_in_threadpool(jobs.spool_upload, file)
+  # Reports outlive their collection, the job then belongs to none
+  job = await jobs.create_job(title=report.title, filename=file.filename, collection_id=report.report_group_id, user=current_user, db=db,
+                              kind=JOB_KINDS['APPEND'], report_id=report.id)
+  try:
+    jobs.submit_report_job(job=job, upload_path=upload_path)
+  except BrokenProcessPool:
+    raise HTTPException(status_code=503, detail="Report workers are unavailable, please try again later.")
 
   response = {
-    "id": report.id,
-    "title": report_name,
-    "user_id": current_user.id,
-    "collection_id": report.report_group_id,
-    "date": report.date,
-    "overall_score": results['scores']['overall_score'],
-    "total_reviews": results['number_of_reviews']['total_reviews'],
-    "fit_score": results['scores']['fit_score'],
-    "fit_reviews": results['number_of_reviews']['fit_reviews'],
-    "color_score": results['scores']['color_score'],
-    "color_reviews": results['number_of_reviews']['color_reviews'],
-    "quality_score": results['scores']['quality_score'],
-    "quality_reviews": results['number_of_reviews']['quality_reviews'],
+    "job_id": job.id,
+    "status": job.status,
   }
-  
   return response
 
-@router.get("/reports/{report_id}", tags=["Dashboard"])
-async def get_report(report_id: int, current_user: User = Depends(get_current_user), db: SessionLocal=Depends(get_db)):
-  report = dashboard.get_report(report_id=report_id, db=db)
+@router.get("/jobs/{job_id}", tags=["Dashboard"])
+async def get_job(job_id: str, current_user: User=Depends(get_current_user), db: AsyncSession=Depends(get_async_db)):
+  job = await jobs.get_job(job_id=job_id, db=db)
+  if job is None:
+    raise HTTPException(status_code=404, detail="Job not found")
+
+  if job.user_id != current_user.id:
+    raise HTTPException(status_code=403, detail="Unauthorized to get this job.")
 
-  if report.user_id != current_user.id:
-    raise HTTPException(status_code=403, detail="Unauthorized to get this report.")
+  response = {
+    "job_id": job.id,
+    "kind": job.kind,
+    "title": job.title,
+    "collection_id": job.report_group_id,
+    "status": job.status,
+    "stage": job.stage,
+    "progress": job.progress,
+    "report_id": job.report_id,
+    "error": job.error,
+    "created_at": job.created_at,
+    "updated_at": job.updated_at,
+  }
+  return response
 
-  report = dashboard.get_report(report_id=report_id, db=db)
+@router.get("/reports/{report_id}", response_model=Report.ReportSummary, tags=["Dashboard"])
+async def get_report(report_id: int, current_user: User = Depends(get_current_user), db: AsyncSession=Depends(get_async_db)):
+  report = await dashboard.get_report(report_id=report_id, user_id=current_user.id, db=db)
+  if report is None:
+    await check_report_access(report_id=report_id, user_id=current_user.id, db=db)
   return report
 
-@router.get("/reports/{report_id}/reviews", tags=["Dashboard"])
-async def get_reviews(report_id: int,
+@router.get("/reports/{report_id}/reviews", response_model=List[Review.ReviewResponse], tags=["Dashboard"])
+async def get_reviews(response: Response,
+                      report_id: int = Depends(authorize_report),
                       page: int = Query(1, gt=0),
                       reviews_per_page: int = Query(10, gt=0, le=50),
-                      current_user: User=Depends(get_current_user), 
-                      db: SessionLocal = Depends(get_db)):
-  report = dashboard.get_report(report_id=report_id, db=db)
-
-  if report.user_id != current_user.id:
-    raise HTTPException(status_code=403, detail="Unauthorized to get this report's reviews.")
-
-
+                      cursor: Optional[str] = Query(None, regex=r'^\d+\.\d+$'),
+                      category: Optional[str] = Query(None, regex='^(FIT|COLOR|QUALITY|OTHER)$'),
+                      sentiment: Optional[str] = Query(None, regex='^(positive|negative)$'),
+                      db: AsyncSession = Depends(get_async_db)):
   offset = (page - 1) * reviews_per_page
   limit = reviews_per_page
-  reviews = dashboard.get_reviews(report_id=report_id, offset=offset, limit=limit, db=db)
-  return reviews
+  review_cursor = dashboard.decode_review_cursor(cursor) if cursor is not None else None
+  reviews = await dashboard.get_reviews(report_id=report_id, offset=offset, limit=limit, cursor=review_cursor,
+                                  category=category, sentiment=sentiment, db=db)
+  if len(reviews) == limit:
+    response.headers["X-Next-Cursor"] = dashboard.encode_review_cursor(reviews[-1])
+  return await dashboard.decode_reviews(reviews, db)
+
+@router.get("/reports/{report_id}/export", tags=["Dashboard"])
+async def export_reviews(report_id: int = Depends(authorize_report),
+                         export_format: str = Query('csv', alias='format', regex='^(csv|ndjson|parquet)$'),
+                         db: AsyncSession = Depends(get_async_db)):
+  headers = {"Content-Disposition": f'attachment; filename="report-{report_id}-reviews.{export_format}"'}
+  content = exports.export_reviews(report_id=report_id, export_format=export_format, db=db)
+  return StreamingResponse(content, media_type=exports.EXPORT_FORMATS[export_format], headers=headers)
 
 @router.get("/reports/{report_id}/word_count", tags=["Dashboard"])
-async def get_word_count(report_id: int, current_user: User=Depends(get_current_user), db: SessionLocal=Depends(get_db)):
-  report = dashboard.get_report(report_id=report_id, db=db)
-
-  if report.user_id != current_user.id:
-    raise HTTPException(status_code=403, detail="Unauthorized to get this report's word count.")
-  
-  wordcloud = dashboard.get_word_count(report_id=report_id, db=db)
+async def get_word_count(report_id: int = Depends(authorize_report),
+                         top: int = Query(dashboard.WORD_COUNT_DEFAULT_TOP, gt=0, le=1000),
+                         category: Optional[str] = Query(None, regex='^(FIT|COLOR|QUALITY|OTHER)$'),
+                         sentiment: Optional[str] = Query(None, regex='^(positive|negative)$'),
+                         db: AsyncSession=Depends(get_async_db)):
+  wordcloud = await dashboard.get_word_count(report_id=report_id, db=db, top=top, category=category, sentiment=sentiment)
   return wordcloud
 
 @router.get("/reports/{report_id}/wordcloud", tags=["Dashboard"])
-async def get_wordcloud(report_id: int, current_user: User=Depends(get_current_user), db: SessionLocal=Depends(get_db)):
-  report = dashboard.get_report(report_id=report_id, db=db)
-
-  if report.user_id != current_user.id:
-    raise HTTPException(status_code=403, detail="Unauthorized to get this report's wordcloud.")
-  
-  wordcloud = dashboard.get_wordcloud(report_id=report_id, db=db)
-  return wordcloud
+async def get_wordcloud(report_id: int = Depends(authorize_report),
+                        width: int = Query(wordclouds.WORDCLOUD_DEFAULT_WIDTH, ge=100, le=2000),
+                        height: int = Query(wordclouds.WORDCLOUD_DEFAULT_HEIGHT, ge=100, le=2000),
+                        image_format: str = Query('png', alias='format', regex='^(png|webp)$'),
+                        db: AsyncSession=Depends(get_async_db)):
+  wordcloud = await wordclouds.get_wordcloud_image(report_id=report_id, db=db, width=width, height=height, image_format=image_format)
+  if wordcloud is None:
+    return {'error': f'Report with id={report_id} not found'}
+  return {'wordcloud': b64encode(wordcloud).decode('utf-8')}
+
+@router.get("/reports/{report_id}/wordcloud/image", tags=["Dashboard"])
+async def get_wordcloud_image(report_id: int = Depends(authorize_report),
+                              width: int = Query(wordclouds.WORDCLOUD_DEFAULT_WIDTH, ge=100, le=2000),
+                              height: int = Query(wordclouds.WORDCLOUD_DEFAULT_HEIGHT, ge=100, le=2000),
+                              image_format: str = Query('png', alias='format', regex='^(png|webp)$'),
+                              if_none_match: Optional[str] = Header(None),
+                              db: AsyncSession=Depends(get_async_db)):
+  headers = {"Cache-Control": wordclouds.WORDCLOUD_CACHE_CONTROL}
+  etag = await wordclouds.get_wordcloud_etag(report_id, width, height, image_format, db)
+  if etag is not None and _etag_matches(if_none_match, etag):
+    return Response(status_code=304, headers={**headers, "ETag": f'"{etag}"'})
+
+  variant = await wordclouds.get_wordcloud_variant(report_id=report_id, db=db, width=width, height=height, image_format=image_format)
+  if variant is None:
+    raise HTTPException(status_code=404, detail="Report not found")
+
+  image, etag = variant
+  headers["ETag"] = f'"{etag}"'
+  if _etag_matches(if_none_match, etag):
+    return Response(status_code=304, headers=headers)
+  return Response(content=image, media_type=wordclouds.WORDCLOUD_FORMATS[image_format], headers=headers)
+
+def _etag_matches(if_none_match: Optional[str], etag: str):
+  if if_none_match is None:
+    return False
+  if if_none_match.strip() == '*':
+    return True
+  candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+  return any(candidate.removeprefix('W/').strip('"') == etag for candidate in candidates)
 
 @router.delete("/collections/{collection_id}", tags=["Dashboard"])
-def delete_collection(collection_id: int, current_user: User=Depends(get_current_user), db: SessionLocal=Depends(get_db)):
-    collections = dashboard.get_collections_by_user(user_id=current_user.id, db=db)
-
-    if int(collection_id) not in [collection.id for collection in collections]:
-      raise HTTPException(status_code=403, detail="Unauthorized to access this collection's reports.")
-
-    deleted_collection = dashboard.delete_collection(collection_id=collection_id, db=db)
+async def delete_collection(collection_id: int = Depends(authorize_collection), db: AsyncSession=Depends(get_async_db)):
+    deleted_collection = await dashboard.delete_collection(collection_id=collection_id, db=db)
     if deleted_collection is None:
         raise HTTPException(status_code=404, detail="Collection not found")
     return {"message": "Collection deleted successfully"}
 
 @router.delete("/reports/{report_id}", tags=["Dashboard"])
-def delete_report(report_id: int, current_user: User=Depends(get_current_user), db: SessionLocal=Depends(get_db)):
-    report = dashboard.get_report(report_id=report_id, db=db)
-
-    if report.user_id != current_user.id:
-      raise HTTPException(status_code=403, detail="Unauthorized to delete this collection.")
-    
-    deleted_report = dashboard.delete_report(report_id=report_id, db=db)
+async def delete_report(report_id: int = Depends(authorize_report), db: AsyncSession=Depends(get_async_db)):
+    deleted_report = await dashboard.delete_report(report_id=report_id, db=db)
     if deleted_report is None:
         raise HTTPException(status_code=404, detail="Report not found")
     return {"message": "Report deleted successfully"}
@@ -0,0 +1,9 @@
+from fastapi import APIRouter, Response
+from monitoring import metrics
+
+router = APIRouter()
+
+@router.get("/metrics", tags=["Monitoring"], include_in_schema=False)
+def get_metrics():
+  content, content_type = metrics.render_metrics()
+  return Response(content=content, media_type=content_type)
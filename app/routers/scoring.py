@@ -0,0 +1,41 @@
+import json
+from typing import List
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, conlist
+from schemas.user import User
+from services.auth_service import get_current_user
+from services import scoring_service as scoring
+
+router = APIRouter()
+
+class ScoringRequest(BaseModel):
+  reviews: conlist(str, min_items=1, max_items=scoring.SCORING_MAX_REVIEWS)
+
+@router.post("/reviews", tags=["Scoring"])
+async def score_reviews(request: ScoringRequest,
+                        response_format: str = Query('json', alias='format', regex='^(json|ndjson)$'),
+                        current_user: User = Depends(get_current_user)):
+  futures = scoring.batcher.submit(request.reviews)
+  if response_format == 'json':
+    results = []
+    try:
+      for index, future in enumerate(futures):
+        results.append({"index": index, **await future})
+    finally:
+      _cancel(futures)
+    return {"results": results}
+  return StreamingResponse(_stream_results(futures), media_type='application/x-ndjson')
+
+async def _stream_results(futures: List):
+  # Each line is sent as soon as the batch holding its review is scored
+  try:
+    for index, future in enumerate(futures):
+      yield json.dumps({"index": index, **await future}) + '\n'
+  finally:
+    _cancel(futures)
+
+def _cancel(futures: List):
+  for future in futures:
+    if not future.done():
+      future.cancel()
@@ -1,8 +1,14 @@
+from typing import Optional
 from sqlalchemy import Column, Integer, String
 from database.database import Base
+from pydantic import BaseModel
 
 class Category(Base):
     __tablename__ = 'categories'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String)
\ No newline at end of file
+    name = Column(String)
+
+    class CategoryResponse(BaseModel):
+        id: int
+        name: Optional[str]
\ No newline at end of file
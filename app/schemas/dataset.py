@@ -1,6 +1,7 @@
 from pydantic import BaseModel, validator
 from sqlalchemy import Column, Date, ForeignKey, Integer, String
 from datetime import date
+from typing import Optional
 from database.database import Base, DB_REPORT_TITLE_MAX_LENGTH
 from sqlalchemy.orm import relationship
 
@@ -16,7 +17,7 @@ class Dataset(Base):
 
   class DatasetCreate(BaseModel):
     title: str
-    report_id: str
+    report_id: Optional[str]
     date: date
 
     @validator('title')
@@ -0,0 +1,41 @@
+from sqlalchemy import Column, DateTime, Float, ForeignKey, Integer, String
+from database.database import Base
+from pydantic import BaseModel
+from typing import Optional
+
+JOB_KINDS = {
+  'CREATE': 'create',
+  'APPEND': 'append'
+}
+JOB_STATUS = {
+  'PENDING': 'pending',
+  'RUNNING': 'running',
+  'COMPLETED': 'completed',
+  'FAILED': 'failed'
+}
+
+class Job(Base):
+  __tablename__ = 'jobs'
+
+  id = Column(String(36), primary_key=True)
+  user_id = Column(Integer, ForeignKey('users.id'), index=True)
+  report_group_id = Column(Integer, ForeignKey('report_groups.id', ondelete='SET NULL'))
+  report_id = Column(Integer, ForeignKey('reports.id', ondelete='SET NULL'))
+  kind = Column(String, nullable=False, default=JOB_KINDS['CREATE'])
+  title = Column(String, nullable=False)
+  filename = Column(String)
+  status = Column(String, nullable=False)
+  stage = Column(String)
+  progress = Column(Float)
+  error = Column(String)
+  created_at = Column(DateTime)
+  updated_at = Column(DateTime)
+
+  class JobCreate(BaseModel):
+    id: str
+    user_id: int
+    report_group_id: Optional[int]
+    title: str
+    filename: str
+    kind: str = JOB_KINDS['CREATE']
+    report_id: Optional[int]
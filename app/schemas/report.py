@@ -1,4 +1,5 @@
 from datetime import date
+from typing import Optional
 from sqlalchemy import Date, Column, Float, ForeignKey, Integer, LargeBinary, String
 from schemas.dataset import Dataset
 from database.database import Base
@@ -11,8 +12,8 @@ class Report(Base):
 
   id = Column(Integer, primary_key=True)
   title = Column(String, nullable=False)
-  user_id = Column(Integer, ForeignKey('users.id'))
-  report_group_id = Column(Integer, ForeignKey('report_groups.id'))
+  user_id = Column(Integer, ForeignKey('users.id'), index=True)
+  report_group_id = Column(Integer, ForeignKey('report_groups.id'), index=True)
   date = Column(Date)
   overall_score = Column(Float)
   fit_score = Column(Float)
@@ -24,6 +25,12 @@ class Report(Base):
   quality_reviews = Column(Integer)
   word_count = Column(JSONB)
   wordcloud = Column(LargeBinary)
+  word_frequencies = Column(JSONB)
+  # Word frequencies by category, sentiment and both, keyed as in sentiment_analysis.word_statistics
+  word_statistics = Column(JSONB)
+  # Number of the next review appended, reserved chunk by chunk so concurrent appends never share one.
+  # NULL until the first append, the reviews being numbered up to total_reviews before
+  next_review_number = Column(Integer)
   dataset = relationship('Dataset', backref='report')
     
   class ReportCreate(BaseModel):
@@ -39,9 +46,36 @@ class Report(Base):
     fit_reviews: int
     color_reviews: int
     quality_reviews: int
-    wordcloud: bytes
+    wordcloud: Optional[bytes]
     word_count: str
+    word_frequencies: Optional[dict]
+    word_statistics: Optional[dict]
   
+  class ReportSummary(BaseModel):
+    id: int
+    title: str
+    user_id: int
+    report_group_id: Optional[int]
+    date: Optional[date]
+    overall_score: Optional[float]
+    fit_score: Optional[float]
+    color_score: Optional[float]
+    quality_score: Optional[float]
+    total_reviews: Optional[int]
+    fit_reviews: Optional[int]
+    color_reviews: Optional[int]
+    quality_reviews: Optional[int]
+
+    class Config:
+      orm_mode = True
+
+  @classmethod
+  def summary_columns(cls):
+    """
+      Columns of a report needed to list and show it, without its word statistics and images
+    """
+    return [getattr(cls, field) for field in cls.ReportSummary.__fields__]
+
   @classmethod
   def create_report(cls, db: Session, report: ReportCreate):
     report_dict = report.dict()
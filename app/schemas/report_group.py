@@ -2,15 +2,24 @@ from sqlalchemy import Column, ForeignKey, Integer, String
 from database.database import Base
 from sqlalchemy.orm import relationship
 from pydantic import BaseModel
+from typing import Optional
 
 class ReportGroup(Base):
     __tablename__ = 'report_groups'
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
     reports = relationship('Report', backref='report_group')
 
     class ReportGroupCreate(BaseModel):
         name: str
-        user_id: int
\ No newline at end of file
+        user_id: int
+
+    class ReportGroupResponse(BaseModel):
+        id: int
+        name: Optional[str]
+        user_id: int
+
+        class Config:
+            orm_mode = True
\ No newline at end of file
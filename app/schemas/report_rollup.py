@@ -0,0 +1,33 @@
+from sqlalchemy import Column, Date, Float, ForeignKey, Integer
+from database.database import Base
+
+class RollupColumns:
+  """
+    Running totals of a set of reports. Scores are summed weighted by the reviews behind them,
+    so the average of the set is the sum divided by its number of reviews
+  """
+  report_count = Column(Integer, nullable=False, default=0)
+  total_reviews = Column(Integer, nullable=False, default=0)
+  fit_reviews = Column(Integer, nullable=False, default=0)
+  color_reviews = Column(Integer, nullable=False, default=0)
+  quality_reviews = Column(Integer, nullable=False, default=0)
+  overall_score_sum = Column(Float, nullable=False, default=0.0)
+  fit_score_sum = Column(Float, nullable=False, default=0.0)
+  color_score_sum = Column(Float, nullable=False, default=0.0)
+  quality_score_sum = Column(Float, nullable=False, default=0.0)
+
+class CollectionRollup(RollupColumns, Base):
+  __tablename__ = 'collection_rollups'
+
+  report_group_id = Column(Integer, ForeignKey('report_groups.id', ondelete='CASCADE'), primary_key=True)
+
+class UserRollup(RollupColumns, Base):
+  __tablename__ = 'user_rollups'
+
+  user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+
+class UserDailyRollup(RollupColumns, Base):
+  __tablename__ = 'user_daily_rollups'
+
+  user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+  day = Column(Date, primary_key=True)
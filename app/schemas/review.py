@@ -1,8 +1,10 @@
+from typing import List, Optional
 from pydantic import BaseModel
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, ForeignKey, Index, Integer, SmallInteger, String
 from database.database import Base
 from sqlalchemy.orm import relationship
 from schemas.category import Category
+from schemas.review_text import ReviewText
 
 class Review(Base):
   __tablename__ = 'reviews'
@@ -11,10 +13,16 @@ class Review(Base):
   dataset_id = Column(Integer, ForeignKey('datasets.id'))
   review_number = Column(Integer, unique=True)
   review_text = Column(String(length=1000))
-  prediction = Column(Integer)
-  fit_score = Column(Integer)
-  color_score = Column(Integer)
-  quality_score = Column(Integer)
+  prediction = Column(SmallInteger)
+  fit_score = Column(SmallInteger)
+  color_score = Column(SmallInteger)
+  quality_score = Column(SmallInteger)
+  # Compact rows keep their categories in a bitmask and their text in review_texts,
+  # rows stored before have a NULL mask and use review_categories and review_text
+  category_mask = Column(SmallInteger)
+  text_id = Column(Integer, ForeignKey('review_texts.id'))
+
+  text = relationship('ReviewText')
 
   categories = relationship(
     "Category",
@@ -24,11 +32,26 @@ class Review(Base):
     backref="reviews"
   )
 
+  __table_args__ = (Index('ix_reviews_dataset_id_review_number', 'dataset_id', 'review_number'),)
+
   class ReviewCreate(BaseModel):
     dataset_id: int
     review_number: int
-    review_text: str
+    review_text: Optional[str]
     prediction: int
-    fit_score: int
-    color_score: int
-    quality_score: int
\ No newline at end of file
+    fit_score: Optional[int]
+    color_score: Optional[int]
+    quality_score: Optional[int]
+    category_mask: Optional[int]
+    text_id: Optional[int]
+
+  class ReviewResponse(BaseModel):
+    id: int
+    dataset_id: int
+    review_number: int
+    review_text: Optional[str]
+    prediction: Optional[int]
+    fit_score: Optional[int]
+    color_score: Optional[int]
+    quality_score: Optional[int]
+    categories: List[Category.CategoryResponse]
\ No newline at end of file
@@ -0,0 +1,9 @@
+from sqlalchemy import Column, Integer, String
+from database.database import Base
+
+class ReviewText(Base):
+  __tablename__ = 'review_texts'
+
+  id = Column(Integer, primary_key=True)
+  digest = Column(String(64), nullable=False, unique=True)
+  text = Column(String(length=1000))
@@ -1,10 +1,7 @@
-from sqlalchemy import Column, Integer, String, UniqueConstraint
+from sqlalchemy import Column, Integer, String, UniqueConstraint, select
 from database.database import Base
-from sqlalchemy.orm import Session
-from passlib.context import CryptContext
-from database.database import get_db
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import BaseModel
 
 class User(Base):
     __tablename__ = "users"
@@ -15,16 +12,19 @@ class User(Base):
 
     __table_args__ = (UniqueConstraint('email', name='unique_email'),)
 
+    class UserPrincipal(BaseModel):
+        id: int
+        email: str
+
     @classmethod
-    def get_by_email(cls, email: str):
-        db = next(get_db())
-        return db.query(User).filter(User.email == email).first()
+    async def get_by_email(cls, db: AsyncSession, email: str):
+        result = await db.execute(select(User).filter(User.email == email))
+        return result.scalars().first()
 
     @classmethod
-    def create(cls, db: Session, email: str, password: str):
-        hashed_password = pwd_context.hash(password)
+    async def create(cls, db: AsyncSession, email: str, hashed_password: str):
         user = User(email=email, hashed_password=hashed_password)
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
         return user
\ No newline at end of file
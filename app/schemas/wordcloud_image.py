@@ -0,0 +1,16 @@
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, LargeBinary, String, UniqueConstraint
+from database.database import Base
+
+class WordcloudImage(Base):
+  __tablename__ = 'wordcloud_images'
+
+  id = Column(Integer, primary_key=True)
+  report_id = Column(Integer, ForeignKey('reports.id', ondelete='CASCADE'), nullable=False)
+  width = Column(Integer, nullable=False)
+  height = Column(Integer, nullable=False)
+  format = Column(String(8), nullable=False)
+  data = Column(LargeBinary, nullable=False)
+  etag = Column(String(64), nullable=False)
+  created_at = Column(DateTime)
+
+  __table_args__ = (UniqueConstraint('report_id', 'width', 'height', 'format', name='unique_wordcloud_variant'),)
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+from database.database import DB_CATEGORY_BITS, DB_CATEGORY_CODES
+
+def categories_from_mask(mask: int):
+  """
+    Decodes a category bitmask into the list of category codes stored for a review
+  """
+  categories = [DB_CATEGORY_CODES[category] for category, bit in DB_CATEGORY_BITS.items() if mask & bit]
+  if len(categories) == 0:
+    categories.append(DB_CATEGORY_CODES['OTHER'])
+  return categories
+
+class KeywordIndex:
+  """
+    Inverted index from each keyword to the bitmask of the categories it belongs to
+  """
+  def __init__(self, keywords: dict):
+    self.index = {}
+    for category, words in keywords.items():
+      for word in words:
+        self.index[word] = self.index.get(word, 0) | DB_CATEGORY_BITS[category]
+
+  def classify(self, review: str):
+    return self.classify_tokens(review.split())
+
+  def classify_tokens(self, tokens):
+    index = self.index
+    mask = 0
+    for word in tokens:
+      mask |= index.get(word, 0)
+    return mask
+
+  def classify_reviews(self, tokens: pd.Series):
+    """
+      Classifies a whole column of preprocessed review tokens into category bitmasks
+    """
+    return np.fromiter((self.classify_tokens(review_tokens) for review_tokens in tokens), dtype=np.uint8, count=len(tokens))
@@ -1,143 +1,242 @@
 from collections import Counter
-import re
-import string
+import os
 import numpy as np
 import pandas as pd
 from wordcloud import WordCloud
-from string import punctuation
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
-from nltk.tokenize import word_tokenize
 from fastapi import UploadFile
 from io import BytesIO
-from database.database import DB_CATEGORY_CODES
-from sentiment_analysis.pickles.pickles import model_overall, cv, model_fit, tfidf_fit, model_color, cv_color, model_quality, tfidf_quality
-from sentiment_analysis.pickles.pickles import fit_words, color_words, quality_words
+from PIL import Image
+from database.database import DB_CATEGORY_BITS
+from monitoring.metrics import instrument, timed
+from sentiment_analysis.pickles.pickles import registry
+from sentiment_analysis.preprocessing import preprocess_reviews
+from sentiment_analysis import parallel
+from sentiment_analysis.vectorization import SharedVectorizer
+from sentiment_analysis.categorization import KeywordIndex, categories_from_mask
+from sentiment_analysis.word_statistics import WordStatistics
+
+ENGINE_CHUNK_SIZE = int(os.getenv("ENGINE_CHUNK_SIZE", 10000))
+PREDICTION_TYPES = ['overall', 'fit', 'color', 'quality']
+
+class ReportAggregates:
+  """
+    Running totals needed to build a report without keeping its reviews in memory
+  """
+  def __init__(self):
+    self.total_reviews = 0
+    self.score_sums = {prediction_type: 0.0 for prediction_type in PREDICTION_TYPES}
+    self.scored_reviews = {prediction_type: 0 for prediction_type in PREDICTION_TYPES}
+    self.word_statistics = WordStatistics()
+
+  @property
+  def word_counter(self):
+    return self.word_statistics.counter()
+
+  @classmethod
+  def from_report(cls, report, word_frequencies: dict):
+    """
+      Rebuilds the running totals of an existing report from its stored scores and counts
+    """
+    aggregates = cls()
+    aggregates.total_reviews = report.total_reviews
+    scored_reviews = {
+      'overall': report.total_reviews,
+      'fit': report.fit_reviews,
+      'color': report.color_reviews,
+      'quality': report.quality_reviews
+    }
+    for prediction_type, reviews in scored_reviews.items():
+      if reviews:
+        aggregates.scored_reviews[prediction_type] = reviews
+        aggregates.score_sums[prediction_type] = getattr(report, f'{prediction_type}_score') * reviews
+    aggregates.word_statistics = WordStatistics.from_dict(word_frequencies, report.word_statistics)
+    return aggregates
+
+  def merge(self, other: 'ReportAggregates'):
+    self.total_reviews += other.total_reviews
+    for prediction_type in PREDICTION_TYPES:
+      self.score_sums[prediction_type] += other.score_sums[prediction_type]
+      self.scored_reviews[prediction_type] += other.scored_reviews[prediction_type]
+    self.word_statistics.merge(other.word_statistics)
+
+  def update(self, df: pd.DataFrame):
+    self.total_reviews += df.shape[0]
+    for prediction_type in PREDICTION_TYPES:
+      scores = df[prediction_type].dropna()
+      self.score_sums[prediction_type] += float(scores.sum())
+      self.scored_reviews[prediction_type] += int(scores.shape[0])
+    with timed('engine.word_statistics'):
+      self.word_statistics.update(df)
+
+  def score(self, prediction_type):
+    if self.scored_reviews[prediction_type] == 0:
+      return float('nan')
+    return self.score_sums[prediction_type] / self.scored_reviews[prediction_type]
+
+  def predictions(self):
+    return {
+      "scores": {
+        "overall_score": self.score('overall'),
+        "fit_score": self.score('fit'),
+        "color_score": self.score('color'),
+        "quality_score": self.score('quality')
+      },
+      "number_of_reviews": {
+        "total_reviews": self.total_reviews,
+        "fit_reviews": self.scored_reviews['fit'],
+        "color_reviews": self.scored_reviews['color'],
+        "quality_reviews": self.scored_reviews['quality'],
+      }
+    }
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+  def word_count(self, top: int = 50):
+    return {word: {'count': count} for word, count in self.word_statistics.top(top)}
 
-stopwords_list = set(stopwords.words('english') + list(punctuation))
-lemma = WordNetLemmatizer()
+_keyword_index = None
 
-def clean_review(review):
-  """
-    Applies the preprocessing to the reviews
-  """
-  review = re.sub("[^a-zA-Z]", " ", review)
-  review = review.translate(str.maketrans("", "", string.punctuation))
-  review = review.lower()
-  review = word_tokenize(review)
-  review = [w for w in review if w not in stopwords_list]
-  review = [lemma.lemmatize(w) for w in review]
-  review = [w for w in review if len(w) > 1]
-  return ' '.join(review)
+def get_keyword_index():
+  global _keyword_index
+  if _keyword_index is None:
+    keywords = {'FIT': registry.keywords('fit'), 'COLOR': registry.keywords('color'), 'QUALITY': registry.keywords('quality')}
+    _keyword_index = KeywordIndex(keywords)
+  return _keyword_index
 
 def classify_review(review):
   """
     Classifies the reviews into 3 categories: fit, color or quality
   """
-  words = set(review.split())
-  categories = []
-
-  if any(word in words for word in fit_words):
-      categories.append(DB_CATEGORY_CODES['FIT']) 
-  if any(word in words for word in color_words):
-      categories.append(DB_CATEGORY_CODES['COLOR'])
-  if any(word in words for word in quality_words):
-      categories.append(DB_CATEGORY_CODES['QUALITY'])
-  if len(categories) == 0:
-      categories.append(DB_CATEGORY_CODES['OTHER'])
-  return categories
-
-def generate_score(df_original, df_specific, model, vectorizer, prediction_type):
-  """
-    Predicts the sentiment of each review and stores them in a new column of the Dataframe
-  """
-  
-  X = vectorizer.transform(df_specific['reviewTextPreprocessed'])
-  y_pred = model.predict(X)
-  df_specific[prediction_type] = y_pred
-  score = np.mean(y_pred)
-  df_original.loc[:, prediction_type] = df_specific.loc[:, prediction_type]
-  return score
-
-def generate_word_count(df: pd.DataFrame):
-  text = ' '.join(df['reviewTextPreprocessed'])
-  word_count = Counter(text.split())
-  word_count = word_count.most_common(50)
-  word_count = {word: {'count': count} for word, count in word_count}
-  return word_count
-
-def generate_category_word_count(df: pd.DataFrame, filter_list_1, filter_list_2):
-  text = ' '.join(df['reviewTextPreprocessed'])
-  word_count = Counter(text.split())
-  
-  word_count = word_count.most_common(30)
-  word_count = {word: {'count': count} for word, count in word_count}
-  return word_count
-
-def generate_wordcloud(df: pd.DataFrame):
-  """
-    Generates the wordcloud
-  """
-  text = ' '.join(df['reviewTextPreprocessed'])
-
-  wordcloud = WordCloud(background_color='white', width=800, height=400, max_words=200, stopwords=stopwords_list, colormap='inferno').generate(text)
-  plt.imshow(wordcloud, interpolation='bilinear')
-  plt.axis('off')
+  return categories_from_mask(get_keyword_index().classify(review))
+
+_shared_vectorizer = None
+
+def get_shared_vectorizer():
+  global _shared_vectorizer
+  if _shared_vectorizer is None:
+    vectorizers = [registry.model(name)[1] for name in ['general', 'fit', 'color', 'quality']]
+    _shared_vectorizer = SharedVectorizer(vectorizers)
+  return _shared_vectorizer
+
+def score_reviews(preprocessed: pd.Series, category_masks: np.ndarray):
+  """
+    Predicts the sentiment of every review with the general model and with the model
+    of each category it belongs to. Reviews outside a category get NaN for its model.
+    The reviews are tokenized once and every model reads its features from those counts
+  """
+  vectorizer = get_shared_vectorizer()
+  with timed('engine.vectorize'):
+    counts = vectorizer.count(preprocessed)
+
+  scores = pd.DataFrame(index=preprocessed.index)
+  model_overall, cv = registry.model('general')
+  with timed('engine.score_overall'):
+    scores['overall'] = model_overall.predict(vectorizer.transform(counts, cv))
+
+  for prediction_type, category in [('fit', 'FIT'), ('color', 'COLOR'), ('quality', 'QUALITY')]:
+    model, category_vectorizer = registry.model(prediction_type)
+    category_bit = DB_CATEGORY_BITS[category]
+    mask = (category_masks & category_bit) != 0
+    scores[prediction_type] = np.nan
+    if mask.any():
+      with timed(f'engine.score_{prediction_type}'):
+        scores.loc[mask, prediction_type] = model.predict(vectorizer.transform(counts, category_vectorizer, rows=mask))
+  return scores
+
+def process_reviews(reviews: pd.Series):
+  """
+    Preprocesses, classifies and scores a column of raw reviews
+  """
+  with timed('engine.preprocess'):
+    tokens, preprocessed = preprocess_reviews(reviews)
+  with timed('engine.classify'):
+    category_masks = get_keyword_index().classify_reviews(tokens)
+  categories = pd.Series([categories_from_mask(mask) for mask in category_masks], index=preprocessed.index, name='category', dtype=object)
+  masks = pd.Series(category_masks, index=preprocessed.index, name='categoryMask')
+  scores = score_reviews(preprocessed, category_masks)
+  return pd.concat([preprocessed.rename('reviewTextPreprocessed'), tokens.rename('reviewTokens'), categories, masks, scores], axis=1)
+
+@instrument('engine.wordcloud')
+def render_wordcloud(frequencies: dict, width: int = 800, height: int = 400, image_format: str = 'png'):
+  """
+    Draws the wordcloud straight from the word counts into an image file, without going through pyplot
+  """
+  wordcloud = WordCloud(background_color='white', width=width, height=height, max_words=200, colormap='inferno').generate_from_frequencies(frequencies)
   image_file = BytesIO()
-  plt.savefig(image_file, format='png')
-  image_file.seek(0)
-  image_data = image_file.read()
-  return image_data
-    
-def predict(file: UploadFile):
-  df = pd.read_csv(file.file)
-  df.rename(columns={0: 'reviewText'})
+  wordcloud.to_image().save(image_file, format=image_format)
+  return image_file.getvalue()
+
+def render_blank_image(width: int = 800, height: int = 400, image_format: str = 'png'):
+  """
+    Draws the empty background shown instead of the wordcloud of a report without any words
+  """
+  image_file = BytesIO()
+  Image.new('RGB', (width, height), 'white').save(image_file, format=image_format)
+  return image_file.getvalue()
+
+def process_frame(df: pd.DataFrame, first_review_number: int = 0):
+  """
+    Preprocesses, classifies and scores the reviews of a DataFrame read from a CSV
+  """
   df['reviewText'] = df['reviewText'].fillna('')
-  df['reviewTextPreprocessed'] = df['reviewText'].apply(clean_review)
-  df['category'] = df['reviewTextPreprocessed'].apply(classify_review)
-  df = df.reset_index(drop=False)
-  df = df.rename(columns={'index': 'reviewNumber'})
-
-  fit_df = df[df['category'].apply(lambda x: DB_CATEGORY_CODES['FIT'] in x)].copy()
-  color_df = df[df['category'].apply(lambda x: DB_CATEGORY_CODES['COLOR'] in x)].copy()
-  quality_df = df[df['category'].apply(lambda x: DB_CATEGORY_CODES['QUALITY'] in x)].copy()
-
-  df['reviewTextPreprocessed'] = df['reviewTextPreprocessed'].fillna('')
-  df['category'] = df['category'].fillna('')
-
-  wordcloud = generate_wordcloud(df)
-
-  overall_score = generate_score(df, df, model_overall, cv, 'overall')
-  fit_score = generate_score(df, fit_df, model_fit, tfidf_fit, 'fit')
-  color_score = generate_score(df, color_df, model_color, cv_color, 'color')
-  quality_score = generate_score(df, quality_df, model_quality, tfidf_quality, 'quality')
-
-  word_count = generate_word_count(df)
-  
-  predictions = {
-    "scores": {
-      "overall_score": overall_score,
-      "fit_score": fit_score,
-      "color_score": color_score,
-      "quality_score": quality_score
-    },
-    "number_of_reviews": {
-      "total_reviews": df.shape[0],
-      "fit_reviews": fit_df.shape[0],
-      "color_reviews": color_df.shape[0],
-      "quality_reviews": quality_df.shape[0],
-    }
-  }
+  results = parallel.map_shards(process_reviews, df['reviewText'])
+  # Columns of the upload named like the computed ones are overwritten by them
+  df = df.drop(columns=[column for column in [*results.columns, 'reviewNumber'] if column in df.columns])
+  df = df.join(results)
+  df = df.reset_index(drop=True)
+  df.insert(0, 'reviewNumber', range(first_review_number, first_review_number + df.shape[0]))
+  return df
+
+def predict(file: UploadFile):
+  return predict_csv(file.file, file.filename)
+
+def predict_csv(file, filename: str):
+  """
+    Runs the whole pipeline over a CSV file object
+  """
+  with timed('engine.read_csv'):
+    df = pd.read_csv(file)
+  df = process_frame(df)
+  aggregates = ReportAggregates()
+  aggregates.update(df)
+
+  word_count = aggregates.word_count()
+  predictions = aggregates.predictions()
 
   report_metadata = {
-    "dataset_title": file.filename
+    "dataset_title": filename
   }
 
-  df = df.fillna(value=-1)
-  reviews_list = df.to_dict(orient='records')
+  reviews_list = reviews_records(df)
+  word_statistics = aggregates.word_statistics
+  return predictions, report_metadata, reviews_list, word_count, word_statistics.frequencies(), word_statistics.breakdowns()
+
+def reviews_records(df: pd.DataFrame):
+  """
+    Rows of the processed reviews to persist, the tokens are only needed for the word statistics
+  """
+  return df.drop(columns='reviewTokens').fillna(value=-1).to_dict(orient='records')
 
-  return predictions, report_metadata, reviews_list, word_count, wordcloud
\ No newline at end of file
+def count_words(reviews: list):
+  """
+    Counts the words of raw reviews after preprocessing them
+  """
+  word_counter = Counter()
+  tokens, _ = preprocess_reviews(pd.Series(reviews, dtype=object).fillna(''))
+  for review_tokens in tokens:
+    word_counter.update(review_tokens)
+  return word_counter
+
+def predict_csv_chunks(file, aggregates: ReportAggregates, chunk_size: int = ENGINE_CHUNK_SIZE, first_review_number: int = 0,
+                       reserve_review_numbers=None):
+  """
+    Runs the pipeline over a CSV file object one chunk at a time, yielding the reviews
+    of each chunk and accumulating everything the report needs into the aggregates.
+    reserve_review_numbers, given the size of a chunk, returns the number of its first review
+  """
+  for chunk in pd.read_csv(file, chunksize=chunk_size):
+    if reserve_review_numbers is not None:
+      chunk_first_number = reserve_review_numbers(chunk.shape[0])
+    else:
+      chunk_first_number = first_review_number + aggregates.total_reviews
+    df = process_frame(chunk, first_review_number=chunk_first_number)
+    aggregates.update(df)
+    yield reviews_records(df)
@@ -0,0 +1,37 @@
+from concurrent.futures import ProcessPoolExecutor
+import math
+import os
+import pandas as pd
+
+ENGINE_WORKERS = int(os.getenv("ENGINE_WORKERS", 1))
+ENGINE_MIN_SHARD_SIZE = int(os.getenv("ENGINE_MIN_SHARD_SIZE", 5000))
+
+_executor = None
+
+def get_executor():
+  global _executor
+  if _executor is None:
+    _executor = ProcessPoolExecutor(max_workers=ENGINE_WORKERS)
+  return _executor
+
+def number_of_shards(rows: int):
+  """
+    Splits the work across at most ENGINE_WORKERS processes, keeping every shard
+    large enough to pay off the cost of shipping it to another process
+  """
+  if ENGINE_WORKERS <= 1:
+    return 1
+  return max(1, min(ENGINE_WORKERS, math.ceil(rows / ENGINE_MIN_SHARD_SIZE)))
+
+def map_shards(function, data):
+  """
+    Applies a function to contiguous shards of a Series or DataFrame in the worker pool
+    and concatenates the results in the original order
+  """
+  shards = number_of_shards(len(data))
+  if shards == 1:
+    return function(data)
+
+  shard_size = math.ceil(len(data) / shards)
+  parts = [data.iloc[start:start + shard_size] for start in range(0, len(data), shard_size)]
+  return pd.concat(get_executor().map(function, parts))
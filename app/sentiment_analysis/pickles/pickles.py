@@ -1,30 +1,167 @@
-import pickle
+import hashlib
+import logging
 import os
+import pickle
+import shutil
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PICKLES_DIR = os.path.dirname(os.path.abspath(__file__))
+MODELS_DIR = os.getenv("MODELS_DIR", os.path.join(PICKLES_DIR, "models"))
+MMAP_MODELS_DIR = os.getenv("MMAP_MODELS_DIR", os.path.join(PICKLES_DIR, "mmap"))
+KEYWORDS_DIR = os.getenv("KEYWORDS_DIR", os.path.join(PICKLES_DIR, "keywords"))
+MODEL_FORMAT = os.getenv("MODEL_FORMAT", "pickle")
+
+MODEL_FILES = {
+  'general': 'general_model',
+  'fit': 'fit_models',
+  'color': 'color_models',
+  'quality': 'quality_models'
+}
+KEYWORD_FILES = {
+  'fit': 'fit_words',
+  'color': 'color_words',
+  'quality': 'quality_words'
+}
+
+# Names this module used to load eagerly, mapped to (model name, position in the pickle)
+LEGACY_NAMES = {
+  'model_overall': ('general', 0),
+  'cv': ('general', 1),
+  'model_fit': ('fit', 0),
+  'tfidf_fit': ('fit', 1),
+  'model_color': ('color', 0),
+  'cv_color': ('color', 1),
+  'model_quality': ('quality', 0),
+  'tfidf_quality': ('quality', 1),
+}
+
+MMAP_SKELETON_FILE = 'skeleton.pkl'
+# Estimators and sparse matrices nested deeper than this keep their arrays inside the skeleton
+MMAP_MAX_DEPTH = 3
+
+def _is_array_holder(value):
+  return hasattr(value, '__dict__') and type(value).__module__.split('.')[0] in ('sklearn', 'scipy')
+
+def _extract_arrays(obj, path: tuple, arrays: list, depth: int = 0):
+  """
+    Detaches the numeric arrays of a fitted object, recording the attribute path of each one
+  """
+  for attribute, value in list(vars(obj).items()):
+    if isinstance(value, np.ndarray) and value.dtype != object:
+      arrays.append((path + (attribute,), value))
+      setattr(obj, attribute, None)
+    elif depth < MMAP_MAX_DEPTH and _is_array_holder(value):
+      _extract_arrays(value, path + (attribute,), arrays, depth + 1)
+
+def export_mmap(name: str, models_dir: str = MODELS_DIR, mmap_dir: str = MMAP_MODELS_DIR):
+  """
+    Converts a pickled model/vectorizer pair into a skeleton pickle plus one .npy file per array
+  """
+  with open(os.path.join(models_dir, MODEL_FILES[name] + '.pkl'), 'rb') as file:
+    objects = list(pickle.load(file))
+
+  arrays = []
+  for position, obj in enumerate(objects):
+    _extract_arrays(obj, (position,), arrays)
+
+  target_dir = os.path.join(mmap_dir, name)
+  shutil.rmtree(target_dir, ignore_errors=True)
+  os.makedirs(target_dir)
+  manifest = []
+  for number, (path, array) in enumerate(arrays):
+    filename = f'{number}.npy'
+    np.save(os.path.join(target_dir, filename), array)
+    manifest.append((path, filename))
+
+  with open(os.path.join(target_dir, MMAP_SKELETON_FILE), 'wb') as file:
+    pickle.dump((objects, manifest), file, protocol=pickle.HIGHEST_PROTOCOL)
+  return target_dir
+
+def _load_mmap(name: str):
+  source_dir = os.path.join(MMAP_MODELS_DIR, name)
+  with open(os.path.join(source_dir, MMAP_SKELETON_FILE), 'rb') as file:
+    objects, manifest = pickle.load(file)
+
+  for path, filename in manifest:
+    obj = objects[path[0]]
+    for attribute in path[1:-1]:
+      obj = getattr(obj, attribute)
+    setattr(obj, path[-1], np.load(os.path.join(source_dir, filename), mmap_mode='r'))
+  return tuple(objects)
+
+def _load_pickle(file_path: str):
+  with open(file_path, 'rb') as file:
+    return pickle.load(file)
+
+class ModelRegistry:
+  """
+    Loads the models, vectorizers and keyword lists the first time they are used.
+    With MODEL_FORMAT=mmap the model arrays are memory-mapped from the exported .npy
+    files, so every worker process on the node shares the same pages
+  """
+  def __init__(self, model_format: str = MODEL_FORMAT):
+    self.model_format = model_format
+    self.load_times = {}
+    self._loaded = {}
+    self._version = None
+    self._lock = threading.Lock()
+
+  def _get(self, key: str, loader):
+    if key not in self._loaded:
+      with self._lock:
+        if key not in self._loaded:
+          start = time.perf_counter()
+          self._loaded[key] = loader()
+          self.load_times[key] = time.perf_counter() - start
+          logger.info("Loaded %s in %.3fs", key, self.load_times[key])
+    return self._loaded[key]
 
-file_path = os.path.abspath("sentiment_analysis/pickles/models/general_model.pkl")
-with open(file_path, 'rb') as file:
-  model_overall, cv = pickle.load(file)
+  def _load_model(self, name: str):
+    if self.model_format == 'mmap':
+      if os.path.exists(os.path.join(MMAP_MODELS_DIR, name, MMAP_SKELETON_FILE)):
+        return _load_mmap(name)
+      logger.warning("No memory-mapped export of the %s model, loading its pickle", name)
+    return tuple(_load_pickle(os.path.join(MODELS_DIR, MODEL_FILES[name] + '.pkl')))
 
-file_path = os.path.abspath("sentiment_analysis/pickles/models/fit_models.pkl")
-with open(file_path, 'rb') as file:
-  model_fit, tfidf_fit = pickle.load(file)
+  def model(self, name: str):
+    """
+      Returns the (model, vectorizer) pair of the given model
+    """
+    return self._get('model:' + name, lambda: self._load_model(name))
 
-file_path = os.path.abspath("sentiment_analysis/pickles/models/color_models.pkl")
-with open(file_path, 'rb') as file:
-  model_color, cv_color = pickle.load(file)
+  def keywords(self, name: str):
+    return self._get('keywords:' + name, lambda: _load_pickle(os.path.join(KEYWORDS_DIR, KEYWORD_FILES[name] + '.pkl')))
 
-file_path = os.path.abspath("sentiment_analysis/pickles/models/quality_models.pkl")
-with open(file_path, 'rb') as file:
-  model_quality, tfidf_quality = pickle.load(file)
+  def version(self):
+    """
+      Returns a digest of the model and keyword pickles, which changes whenever any of them is replaced
+    """
+    if self._version is None:
+      digest = hashlib.sha256()
+      file_paths = [os.path.join(MODELS_DIR, MODEL_FILES[name] + '.pkl') for name in sorted(MODEL_FILES)]
+      file_paths += [os.path.join(KEYWORDS_DIR, KEYWORD_FILES[name] + '.pkl') for name in sorted(KEYWORD_FILES)]
+      for file_path in file_paths:
+        with open(file_path, 'rb') as file:
+          for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+      self._version = digest.hexdigest()
+    return self._version
 
-file_path = os.path.abspath("sentiment_analysis/pickles/keywords/fit_words.pkl")
-with open(file_path, 'rb') as file:
-  fit_words = pickle.load(file)
+registry = ModelRegistry()
 
-file_path = os.path.abspath("sentiment_analysis/pickles/keywords/color_words.pkl")
-with open(file_path, 'rb') as file:
-  color_words = pickle.load(file)
+def __getattr__(name):
+  if name in LEGACY_NAMES:
+    model_name, position = LEGACY_NAMES[name]
+    return registry.model(model_name)[position]
+  if name.endswith('_words') and name[:-len('_words')] in KEYWORD_FILES:
+    return registry.keywords(name[:-len('_words')])
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-file_path = os.path.abspath("sentiment_analysis/pickles/keywords/quality_words.pkl")
-with open(file_path, 'rb') as file:
-  quality_words = pickle.load(file)
\ No newline at end of file
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  for model_name in MODEL_FILES:
+    logger.info("Exported %s to %s", model_name, export_mmap(model_name))
@@ -0,0 +1,86 @@
+from functools import lru_cache
+import os
+import re
+from string import punctuation
+import pandas as pd
+from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
+
+LEMMA_CACHE_SIZE = int(os.getenv("LEMMA_CACHE_SIZE", 100000))
+# Cleaned texts are kept across uploads, so reviews that repeat between files are cleaned once
+REVIEW_CACHE_SIZE = int(os.getenv("REVIEW_CACHE_SIZE", 50000))
+
+stopwords_list = set(stopwords.words('english') + list(punctuation))
+lemma = WordNetLemmatizer()
+
+# Only ASCII letters survive the cleaning, so every token is a run of letters
+_TOKEN_RE = re.compile("[a-zA-Z]+")
+
+# Letters-only words that NLTK's word_tokenize splits in two
+_TOKENIZER_SPLITS = {
+  'cannot': ('can', 'not'),
+  'gimme': ('gim', 'me'),
+  'gonna': ('gon', 'na'),
+  'gotta': ('got', 'ta'),
+  'lemme': ('lem', 'me'),
+  'wanna': ('wan', 'na'),
+}
+
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def _normalize_token(token):
+  """
+    Maps a lowercase token to its lemma, or to an empty string if it has to be dropped
+  """
+  if token in stopwords_list:
+    return ''
+  token = lemma.lemmatize(token)
+  if len(token) <= 1:
+    return ''
+  return token
+
+def tokenize_review(review):
+  """
+    Splits a raw review into the lowercase tokens word_tokenize would produce after cleaning
+  """
+  review = ' '.join(_TOKEN_RE.findall(review)).lower()
+  tokens = []
+  for token in review.split():
+    if token in _TOKENIZER_SPLITS:
+      tokens.extend(_TOKENIZER_SPLITS[token])
+    else:
+      tokens.append(token)
+  return tokens
+
+@lru_cache(maxsize=REVIEW_CACHE_SIZE)
+def review_tokens(review):
+  """
+    Applies the preprocessing to a review and returns the tokens that remain
+  """
+  words = [_normalize_token(token) for token in tokenize_review(review)]
+  return tuple(word for word in words if word)
+
+def clean_review(review):
+  """
+    Applies the preprocessing to a review
+  """
+  return ' '.join(review_tokens(review))
+
+def preprocess_reviews(reviews: pd.Series):
+  """
+    Applies the preprocessing to a whole column of reviews, handling each distinct text once.
+    Returns the tokens of every review and the cleaned texts the vectorizers read
+  """
+  tokens = {}
+  for review in reviews:
+    if review not in tokens:
+      tokens[review] = review_tokens(review)
+  cleaned = {review: ' '.join(words) for review, words in tokens.items()}
+  token_column = pd.Series([tokens[review] for review in reviews], index=reviews.index, dtype=object)
+  cleaned_column = pd.Series([cleaned[review] for review in reviews], index=reviews.index, dtype=object)
+  return token_column, cleaned_column
+
+def clean_reviews(reviews: pd.Series):
+  """
+    Applies the preprocessing to a whole column of reviews, cleaning each distinct text once
+  """
+  return preprocess_reviews(reviews)[1]
@@ -0,0 +1,109 @@
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from sentiment_analysis.pickles.pickles import registry
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "garmentwise-results"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+# Uploads above this size are not cached, their entries would evict everything else
+RESULT_CACHE_MAX_FILE_BYTES = int(os.getenv("RESULT_CACHE_MAX_FILE_BYTES", 20 * 1024 * 1024))
+
+# Bumped whenever the preprocessing or the scoring changes what the pipeline produces
+PIPELINE_VERSION = '2'
+
+ENTRY_SUFFIX = '.pkl'
+
+def file_digest(file_path: str):
+  digest = hashlib.sha256()
+  with open(file_path, 'rb') as file:
+    for block in iter(lambda: file.read(1024 * 1024), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+def cache_key(file_path: str):
+  """
+    Addresses the results of a file by its contents and the models that scored it
+  """
+  key = f'{file_digest(file_path)}:{registry.version()}:{PIPELINE_VERSION}'
+  return hashlib.sha256(key.encode()).hexdigest()
+
+def wordcloud_key(key: str):
+  # Kept apart from the results so serving the image does not load the reviews
+  return key + '-wordcloud'
+
+class ResultCache:
+  """
+    On-disk cache of pipeline results, one pickle per key. Reading an entry refreshes its
+    modification time, and the least recently used entries are dropped once the directory
+    grows over max_bytes
+  """
+  def __init__(self, directory: str = RESULT_CACHE_DIR, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+
+  def _path(self, key: str):
+    return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+  def get(self, key: str):
+    path = self._path(key)
+    try:
+      with open(path, 'rb') as file:
+        entry = pickle.load(file)
+      os.utime(path)
+      return entry
+    except FileNotFoundError:
+      return None
+    except Exception:
+      logger.exception("Discarding unreadable result cache entry %s", key)
+      self.delete(key)
+      return None
+
+  def put(self, key: str, entry):
+    os.makedirs(self.directory, exist_ok=True)
+    # Written under a temporary name so readers in other processes never see a partial entry
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+    try:
+      with os.fdopen(fd, 'wb') as file:
+        pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(temp_path, self._path(key))
+    except Exception:
+      os.remove(temp_path)
+      raise
+    self.evict()
+
+  def delete(self, key: str):
+    try:
+      os.remove(self._path(key))
+    except FileNotFoundError:
+      pass
+
+  def evict(self):
+    with self._lock:
+      entries = []
+      for entry in os.scandir(self.directory):
+        if not entry.name.endswith(ENTRY_SUFFIX):
+          continue
+        try:
+          stat = entry.stat()
+        except FileNotFoundError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+      total_bytes = sum(size for _, size, _ in entries)
+      for _, size, path in sorted(entries):
+        if total_bytes <= self.max_bytes:
+          break
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+        total_bytes -= size
+
+result_cache = ResultCache()
@@ -0,0 +1,70 @@
+import numpy as np
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+# Parameters that decide how a document is turned into terms
+ANALYZER_PARAMS = ['input', 'encoding', 'decode_error', 'strip_accents', 'lowercase', 'preprocessor',
+                   'tokenizer', 'stop_words', 'token_pattern', 'ngram_range', 'analyzer']
+
+def shares_analyzer(vectorizers: list):
+  """
+    Checks that every vectorizer splits documents into terms the same way
+  """
+  params = [{param: getattr(vectorizer, param) for param in ANALYZER_PARAMS} for vectorizer in vectorizers]
+  return all(vectorizer_params == params[0] for vectorizer_params in params)
+
+class SharedVectorizer:
+  """
+    Tokenizes a corpus once into a term-count matrix over the union of the vocabularies
+    of several fitted vectorizers, and derives each vectorizer's features from it
+  """
+  def __init__(self, vectorizers: list):
+    self.shared = shares_analyzer(vectorizers)
+    if not self.shared:
+      return
+
+    vocabulary = {}
+    for vectorizer in vectorizers:
+      for term in vectorizer.vocabulary_:
+        vocabulary.setdefault(term, len(vocabulary))
+
+    analyzer_params = {param: getattr(vectorizers[0], param) for param in ANALYZER_PARAMS}
+    self.counter = CountVectorizer(vocabulary=vocabulary, dtype=np.int64, **analyzer_params)
+    self.columns = {}
+    for vectorizer in vectorizers:
+      columns = np.empty(len(vectorizer.vocabulary_), dtype=np.intp)
+      for term, index in vectorizer.vocabulary_.items():
+        columns[index] = vocabulary[term]
+      self.columns[id(vectorizer)] = columns
+
+  def count(self, documents):
+    """
+      Builds the shared term-count matrix. When the vectorizers tokenize differently the
+      documents are returned as they are and every transform tokenizes them again
+    """
+    if not self.shared:
+      return documents
+    return self.counter.transform(documents)
+
+  def transform(self, counts, vectorizer, rows=None):
+    """
+      Equivalent to vectorizer.transform over the documents of the given rows
+    """
+    if rows is not None:
+      counts = counts[rows]
+    if not self.shared:
+      return vectorizer.transform(counts)
+
+    X = counts[:, self.columns[id(vectorizer)]].astype(vectorizer.dtype)
+    X.sort_indices()
+    if vectorizer.binary:
+      X.data.fill(1)
+    if isinstance(vectorizer, TfidfVectorizer):
+      if vectorizer.sublinear_tf:
+        np.log(X.data, X.data)
+        X.data += 1
+      if vectorizer.use_idf:
+        X = X.multiply(vectorizer.idf_).tocsr()
+      if vectorizer.norm is not None:
+        X = normalize(X, norm=vectorizer.norm, copy=False)
+    return X
@@ -0,0 +1,114 @@
+from collections import Counter
+import pandas as pd
+from database.database import DB_CATEGORY_BITS, DB_SENTIMENT_VALUES
+
+ALL_WORDS = 'all'
+# Score that decides the sentiment of a review within each category, as the reviews filters do
+CATEGORY_PREDICTIONS = {
+  'FIT': 'fit',
+  'COLOR': 'color',
+  'QUALITY': 'quality',
+  'OTHER': 'overall'
+}
+SENTIMENTS = {value: sentiment for sentiment, value in DB_SENTIMENT_VALUES.items()}
+
+def breakdown_key(category: str = None, sentiment: str = None):
+  """
+    Name of the frequency table of the reviews in a category and/or with a sentiment
+  """
+  if category is None and sentiment is None:
+    return ALL_WORDS
+  if category is None:
+    return sentiment
+  if sentiment is None:
+    return category
+  return f'{category}:{sentiment}'
+
+def _sentiment(score):
+  if pd.isna(score):
+    return None
+  return SENTIMENTS.get(int(score))
+
+def review_breakdowns(mask: int, scores: dict):
+  """
+    Every frequency table a review with the given category mask and scores counts towards
+  """
+  categories = [category for category, bit in DB_CATEGORY_BITS.items() if mask & bit] or ['OTHER']
+  keys = [ALL_WORDS]
+  sentiment = _sentiment(scores['overall'])
+  if sentiment is not None:
+    keys.append(sentiment)
+  for category in categories:
+    keys.append(category)
+    category_sentiment = _sentiment(scores[CATEGORY_PREDICTIONS[category]])
+    if category_sentiment is not None:
+      keys.append(breakdown_key(category, category_sentiment))
+  return tuple(keys)
+
+class WordStatistics:
+  """
+    Word frequencies of a report, overall and broken down by category, sentiment and both.
+    Reviews are counted once into a table per distinct combination of breakdowns, which
+    are only fanned out to the breakdowns themselves when the statistics are read
+  """
+  def __init__(self):
+    self._pending = {}
+    self._counters = {ALL_WORDS: Counter()}
+    # Reports created before the breakdowns were stored only have the overall table
+    self.has_breakdowns = True
+
+  @classmethod
+  def from_dict(cls, frequencies: dict, breakdowns: dict = None):
+    statistics = cls()
+    statistics._counters[ALL_WORDS] = Counter(frequencies)
+    if breakdowns is None:
+      statistics.has_breakdowns = not frequencies
+    else:
+      for key, counts in breakdowns.items():
+        statistics._counters[key] = Counter(counts)
+    return statistics
+
+  def update(self, df: pd.DataFrame):
+    """
+      Counts the tokens of the processed reviews of a DataFrame
+    """
+    predictions = list(CATEGORY_PREDICTIONS.values())
+    rows = zip(df['reviewTokens'], df['categoryMask'], *(df[prediction] for prediction in predictions))
+    for tokens, mask, *scores in rows:
+      keys = review_breakdowns(int(mask), dict(zip(predictions, scores)))
+      counter = self._pending.get(keys)
+      if counter is None:
+        counter = self._pending[keys] = Counter()
+      counter.update(tokens)
+
+  def _flush(self):
+    for keys, counter in self._pending.items():
+      for key in keys:
+        self._counters.setdefault(key, Counter()).update(counter)
+    self._pending = {}
+
+  def counter(self, key: str = ALL_WORDS):
+    self._flush()
+    return self._counters.get(key, Counter())
+
+  def merge(self, other: 'WordStatistics'):
+    self._flush()
+    other._flush()
+    self.has_breakdowns = self.has_breakdowns and other.has_breakdowns
+    for key, counter in other._counters.items():
+      self._counters.setdefault(key, Counter()).update(counter)
+
+  def frequencies(self):
+    return dict(self.counter(ALL_WORDS))
+
+  def breakdowns(self):
+    """
+      Frequency tables other than the overall one, None if they are incomplete
+    """
+    self._flush()
+    if not self.has_breakdowns:
+      return None
+    return {key: dict(counter) for key, counter in self._counters.items() if key != ALL_WORDS}
+
+  def top(self, k: int, category: str = None, sentiment: str = None):
+    return self.counter(breakdown_key(category, sentiment)).most_common(k)
@@ -1,31 +1,87 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import threading
+import time
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 from jose import jwt, JWTError
+from sqlalchemy import event, inspect
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from schemas.user import User
 from database.database import get_db
 import os
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 4))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# bcrypt is deliberately slow, so it runs here instead of on the event loop
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password")
+
 ACCESS_TOKEN_EXPIRE_MINUTES = 120
+SECRET_KEY = os.getenv("SECRET_KEY")
+ALGORITHM = os.getenv("ALGORITHM")
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", 60))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", 10000))
+
+# Principals of recently authenticated users by email, with the time they expire at
+_principal_cache = {}
+_principal_cache_lock = threading.Lock()
+
+def get_cached_principal(email: str):
+  entry = _principal_cache.get(email)
+  if entry is None:
+    return None
+  expires_at, principal = entry
+  if expires_at < time.monotonic():
+    invalidate_principal(email)
+    return None
+  return principal
+
+def cache_principal(principal: User.UserPrincipal):
+  with _principal_cache_lock:
+    _principal_cache.pop(principal.email, None)
+    if len(_principal_cache) >= USER_CACHE_MAX_SIZE:
+      _principal_cache.pop(next(iter(_principal_cache)))
+    _principal_cache[principal.email] = (time.monotonic() + USER_CACHE_TTL_SECONDS, principal)
+
+def invalidate_principal(email: str):
+  with _principal_cache_lock:
+    _principal_cache.pop(email, None)
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_changed_user(mapper, connection, user: User):
+  invalidate_principal(user.email)
+  for previous_email in inspect(user).attrs.email.history.deleted:
+    invalidate_principal(previous_email)
 
-def user_exists(email: str, db: Session = Depends(get_db)):
-  existing_user = db.query(User).filter(User.email == email).params(email=email).first()
+async def user_exists(email: str, db: AsyncSession):
+  existing_user = await User.get_by_email(db=db, email=email)
   if existing_user:
     return True
   else:
     return False
 
 
-def authenticate_user(email: str, password: str):
-  user = User.get_by_email(email=email)
+async def hash_password(password: str):
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(_password_executor, pwd_context.hash, password)
+
+async def verify_password(password: str, hashed_password: str):
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(_password_executor, pwd_context.verify, password, hashed_password)
+
+async def authenticate_user(email: str, password: str, db: AsyncSession):
+  user = await User.get_by_email(db=db, email=email)
   if not user:
     return False
-  if not pwd_context.verify(password, user.hashed_password):
+  if not await verify_password(password, user.hashed_password):
     return False
   return user
 
@@ -37,19 +93,35 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
   else:
     expire = datetime.utcnow() + timedelta(minutes=30)
   to_encode.update({"exp": expire})
-  encoded_jwt = jwt.encode(to_encode, os.getenv("SECRET_KEY"), algorithm=os.getenv("ALGORITHM"))
+  encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
   return encoded_jwt
 
 
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+  """
+    Returns the principal of the token's user. Recently seen users are served from an
+    in-process cache, so most requests are authenticated without querying the database
+  """
   try:
-    payload = jwt.decode(token, os.getenv("SECRET_KEY"), algorithms=[os.getenv("ALGORITHM")])
-    email: str = payload.get("sub")
-    if email is None:
-      raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
-    user = db.query(User).filter(User.email == email).first()
-    if user is None:
-      raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-    return user
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
   except JWTError:
-    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
\ No newline at end of file
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
+
+  email: str = payload.get("sub")
+  user_id: int = payload.get("uid")
+  if email is None:
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
+
+  principal = get_cached_principal(email)
+  if principal is None:
+    # Tokens issued before the user id was embedded only carry the email
+    query = db.query(User.id, User.email)
+    user = query.filter(User.id == user_id).first() if user_id is not None else query.filter(User.email == email).first()
+    if user is None or user.email != email:
+      raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    principal = User.UserPrincipal(id=user.id, email=user.email)
+    cache_principal(principal)
+
+  if user_id is not None and principal.id != user_id:
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
+  return principal
@@ -0,0 +1,50 @@
+from fastapi import Depends, HTTPException
+from sqlalchemy import exists, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import get_async_db
+from schemas.report import Report
+from schemas.report_group import ReportGroup
+from schemas.user import User
+from services.auth_service import get_current_user
+
+async def owns_collection(collection_id: int, user_id: int, db: AsyncSession):
+  result = await db.execute(select(exists().where(ReportGroup.id == collection_id, ReportGroup.user_id == user_id)))
+  return result.scalar()
+
+async def get_report_owner(report_id: int, db: AsyncSession):
+  result = await db.execute(select(Report.user_id).filter_by(id=report_id))
+  return result.scalar()
+
+def _check_report_owner(owner_id: int, user_id: int):
+  if owner_id is None:
+    raise HTTPException(status_code=404, detail="Report not found")
+  if owner_id != user_id:
+    raise HTTPException(status_code=403, detail="Unauthorized to access this report.")
+
+async def check_report_access(report_id: int, user_id: int, db: AsyncSession):
+  owner_id = await get_report_owner(report_id=report_id, db=db)
+  _check_report_owner(owner_id, user_id)
+
+async def authorize_collection(collection_id: int, current_user: User=Depends(get_current_user), db: AsyncSession=Depends(get_async_db)):
+  """
+    Dependency that only lets the owner of the collection in the path through
+  """
+  if not await owns_collection(collection_id=collection_id, user_id=current_user.id, db=db):
+    raise HTTPException(status_code=403, detail="Unauthorized to access this collection.")
+  return collection_id
+
+async def authorize_report(report_id: int, current_user: User=Depends(get_current_user), db: AsyncSession=Depends(get_async_db)):
+  """
+    Dependency that only lets the owner of the report in the path through
+  """
+  await check_report_access(report_id=report_id, user_id=current_user.id, db=db)
+  return report_id
+
+async def authorize_report_row(report_id: int, current_user: User=Depends(get_current_user), db: AsyncSession=Depends(get_async_db)):
+  """
+    Dependency like authorize_report that also returns the title and collection of the report
+  """
+  result = await db.execute(select(Report.id, Report.user_id, Report.title, Report.report_group_id).filter_by(id=report_id))
+  report = result.first()
+  _check_report_owner(report.user_id if report is not None else None, current_user.id)
+  return report
@@ -1,39 +1,70 @@
-from base64 import b64encode
 from datetime import datetime
 import json
 from schemas.user import User
 from schemas.report_group import ReportGroup
 from schemas.review import Review
 from schemas.dataset import Dataset
-from database.database import SessionLocal
+from database.database import SessionLocal, DB_BULK_BATCH_SIZE, DB_CATEGORY_BITS, DB_CATEGORY_CODES, DB_SENTIMENT_VALUES
 from schemas.report import Report
 from schemas.review_categories import review_categories
-from sqlalchemy.orm import joinedload, defer
+from schemas.review_text import ReviewText
+from monitoring.metrics import instrument
+from services import rollup_service as rollups
+from services import review_storage_service as review_storage
+from sentiment_analysis.word_statistics import ALL_WORDS, breakdown_key
+from sqlalchemy import Integer, case, delete, exists, func, insert, or_, select, true, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import defer
 
-def save_collection(collection_name: str, user: User, db: SessionLocal):
+WORD_COUNT_DEFAULT_TOP = 50
+COLLECTION_COLUMNS = [ReportGroup.id, ReportGroup.name, ReportGroup.user_id]
+
+# Prediction that decides the sentiment of a review within each category
+CATEGORY_SCORE_COLUMNS = {
+  'FIT': Review.fit_score,
+  'COLOR': Review.color_score,
+  'QUALITY': Review.quality_score,
+  'OTHER': Review.prediction
+}
+
+@instrument('db.save_collection')
+async def save_collection(collection_name: str, user: User, db: AsyncSession):
   report_group = ReportGroup.ReportGroupCreate(name=collection_name, user_id=user.id)
   db_report_group = ReportGroup(**report_group.dict())
   db.add(db_report_group)
-  db.commit()
-  db.refresh(db_report_group)
+  await db.commit()
+  await db.refresh(db_report_group)
   return db_report_group
 
+@instrument('db.save_report')
 def save_report(report_data: dict, db: SessionLocal):
   report = Report.ReportCreate(**report_data)
   db_report = Report(**report.dict())
   db.add(db_report)
+  db.flush()
+  rollups.apply_rollups(db_report, rollups.report_rollup_values(db_report), db)
   db.commit()
   db.refresh(db_report)
   return db_report
 
+@instrument('db.save_dataset')
 def save_dataset(report: Report, report_metadata: dict, db: SessionLocal):
-  dataset_create_data = Dataset.DatasetCreate(title=report_metadata['dataset_title'], report_id=report.id, date=datetime.now())
+  report_id = report.id if report is not None else None
+  dataset_create_data = Dataset.DatasetCreate(title=report_metadata['dataset_title'], report_id=report_id, date=datetime.now())
   db_dataset = Dataset(**dataset_create_data.dict())
   db.add(db_dataset)
   db.commit()
   db.refresh(db_dataset)
   return db_dataset
 
+@instrument('db.attach_dataset')
+def attach_dataset(dataset: Dataset, report: Report, db: SessionLocal):
+  dataset.report_id = report.id
+  db.commit()
+  db.refresh(dataset)
+  return dataset
+
+@instrument('db.save_reviews')
 def save_reviews(dataset: Dataset, reviews_list: list, db: SessionLocal):
   reviews_categories = []
   for review in reviews_list:
@@ -51,72 +82,301 @@ def save_reviews(dataset: Dataset, reviews_list: list, db: SessionLocal):
     reviews_categories.append({"review_id": db_review.id, "category": review['category']})
   return reviews_categories
 
+@instrument('db.save_review_categories')
 def save_review_categories(reviews_categories_list: list, db: SessionLocal):
   for review_category in reviews_categories_list:
     for category in review_category['category']:
       db.execute(review_categories.insert().values(review_id=review_category['review_id'], category_id=category))
       db.commit()
 
-def get_collection(collection_id: int, db: SessionLocal):
-  collection = db.query(ReportGroup).filter_by(id=collection_id).first()
+@instrument('db.save_reviews_bulk')
+def save_reviews_bulk(dataset: Dataset, reviews_list: list, db: SessionLocal, batch_size: int = DB_BULK_BATCH_SIZE):
+  """
+    Persists the reviews of a dataset and their category links in a single transaction,
+    issuing one multi-row INSERT per batch instead of a round trip per row
+  """
+  insert_reviews = insert(Review).returning(Review.id, Review.review_number)
+  try:
+    for start in range(0, len(reviews_list), batch_size):
+      batch = reviews_list[start:start + batch_size]
+      if review_storage.is_compact():
+        # Categories travel in the row itself, so no ids have to be returned
+        text_ids = review_storage.save_review_texts([review['reviewText'] for review in batch], db)
+        db.execute(insert(Review), [review_storage.compact_review_row(dataset.id, review, text_ids) for review in batch])
+        continue
+
+      rows = [{
+        "dataset_id": dataset.id,
+        "review_number": int(review['reviewNumber']),
+        "review_text": review['reviewText'],
+        "prediction": int(review['overall']),
+        "fit_score": int(review['fit']),
+        "color_score": int(review['color']),
+        "quality_score": int(review['quality']),
+      } for review in batch]
+      review_ids = {review_number: review_id for review_id, review_number in db.execute(insert_reviews, rows)}
+
+      category_rows = [
+        {"review_id": review_ids[int(review['reviewNumber'])], "category_id": category}
+        for review in batch for category in review['category']
+      ]
+      if category_rows:
+        db.execute(review_categories.insert(), category_rows)
+    db.commit()
+  except Exception:
+    db.rollback()
+    raise
+
+@instrument('db.delete_dataset')
+def delete_dataset(dataset_id: int, db: SessionLocal):
+  """
+    Removes a dataset with its reviews, their category links and the texts no other review shares
+  """
+  review_ids = select(Review.id).filter(Review.dataset_id == dataset_id)
+  text_ids = db.execute(select(Review.text_id).filter(Review.dataset_id == dataset_id, Review.text_id.is_not(None)).distinct()).scalars().all()
+  db.execute(review_categories.delete().where(review_categories.c.review_id.in_(review_ids)))
+  db.execute(delete(Review).filter(Review.dataset_id == dataset_id))
+  db.execute(delete(Dataset).filter(Dataset.id == dataset_id))
+  if text_ids:
+    db.execute(delete(ReviewText).filter(ReviewText.id.in_(text_ids), ~exists().where(Review.text_id == ReviewText.id)))
+  db.commit()
+
+@instrument('db.discard_report')
+def discard_report(report_id: int, db: SessionLocal):
+  """
+    Removes a report whose job failed, with its datasets and its contribution to the rollups
+  """
+  dataset_ids = db.execute(select(Dataset.id).filter(Dataset.report_id == report_id)).scalars().all()
+  for dataset_id in dataset_ids:
+    delete_dataset(dataset_id=dataset_id, db=db)
+  report = db.get(Report, report_id, options=[defer(Report.wordcloud), defer(Report.word_frequencies), defer(Report.word_statistics)])
+  if report is None:
+    return
+  rollups.apply_rollups(report, rollups.report_rollup_values(report, sign=-1), db)
+  db.delete(report)
+  db.commit()
+
+@instrument('db.get_report_for_update')
+def get_report_for_update(report_id: int, db: SessionLocal):
+  report = db.query(Report).options(defer(Report.wordcloud)).filter_by(id=report_id).with_for_update().first()
+  return report
+
+@instrument('db.reserve_review_numbers')
+def reserve_review_numbers(report_id: int, count: int, db: SessionLocal):
+  """
+    Reserves the numbers of the next count reviews of a report and returns the first one.
+    The report row is only locked by the single UPDATE that moves the counter
+  """
+  next_number = func.coalesce(Report.next_review_number, Report.total_reviews, 0)
+  last_number = db.execute(
+    update(Report)
+    .filter(Report.id == report_id)
+    .values(next_review_number=next_number + count)
+    .returning(Report.next_review_number)
+  ).scalar()
+  db.commit()
+  return last_number - count
+
+@instrument('db.update_report_aggregates')
+def update_report_aggregates(report: Report, aggregates, db: SessionLocal):
+  previous_values = rollups.report_rollup_values(report)
+  results = aggregates.predictions()
+  for column, value in {**results['scores'], **results['number_of_reviews']}.items():
+    setattr(report, column, value)
+  report.word_count = json.dumps(aggregates.word_count())
+  report.word_frequencies = aggregates.word_statistics.frequencies()
+  report.word_statistics = aggregates.word_statistics.breakdowns()
+  values = rollups.subtract_rollup_values(rollups.report_rollup_values(report), previous_values)
+  rollups.apply_rollups(report, values, db)
+  db.commit()
+  db.refresh(report)
+  return report
+
+def get_review_texts(report_id: int, db: SessionLocal, batch_size: int = DB_BULK_BATCH_SIZE):
+  """
+    Yields the texts of the reviews of a report in batches, through a server-side cursor
+  """
+  result = db.execute(
+    select(func.coalesce(ReviewText.text, Review.review_text))
+    .select_from(Review)
+    .join(Dataset)
+    .outerjoin(ReviewText, Review.text_id == ReviewText.id)
+    .filter(Dataset.report_id == report_id)
+    .execution_options(yield_per=batch_size)
+  )
+  for texts in result.scalars().partitions():
+    yield texts
+
+@instrument('db.get_collection')
+async def get_collection(collection_id: int, user_id: int, db: AsyncSession):
+  result = await db.execute(select(*COLLECTION_COLUMNS).filter_by(id=collection_id, user_id=user_id))
+  collection = result.first()
   return collection
 
-def get_collections_by_user(user_id: int, db: SessionLocal):
-  collections = db.query(ReportGroup).filter_by(user_id=user_id).all()
+@instrument('db.get_collections_by_user')
+async def get_collections_by_user(user_id: int, db: AsyncSession):
+  result = await db.execute(select(*COLLECTION_COLUMNS).filter_by(user_id=user_id))
+  collections = result.all()
   return collections
 
-def get_reports_by_collection(report_group_id: int, db: SessionLocal):
-  reports = reports = db.query(Report).options(defer(Report.wordcloud)).filter_by(report_group_id=report_group_id).all()
+@instrument('db.get_reports_by_collection')
+async def get_reports_by_collection(report_group_id: int, db: AsyncSession):
+  result = await db.execute(select(*Report.summary_columns()).filter_by(report_group_id=report_group_id))
+  reports = result.all()
   return reports
 
-def get_report(report_id: int, db: SessionLocal):
-  report = db.query(Report).options(defer(Report.wordcloud), defer(Report.word_count)).filter_by(id=report_id).first()
+@instrument('db.get_report')
+async def get_report(report_id: int, user_id: int, db: AsyncSession):
+  result = await db.execute(select(*Report.summary_columns()).filter_by(id=report_id, user_id=user_id))
+  report = result.first()
   return report
 
-def get_reports_info_by_user(user_id: int, db: SessionLocal):
-  reports = db.query(Report).filter_by(user_id=user_id).all()
-  reports_ids = {report.id: report.title for report in reports}
+@instrument('db.get_reports_info_by_user')
+async def get_reports_info_by_user(user_id: int, db: AsyncSession):
+  result = await db.execute(select(Report.id, Report.title).filter_by(user_id=user_id))
+  reports_ids = {report.id: report.title for report in result}
   return reports_ids
 
-def get_reviews(report_id: int, offset: int, limit: int, db: SessionLocal):
-  reviews = (
-    db.query(Review)
-    .options(joinedload(Review.categories))
-    .join(Dataset)
-    .filter(Dataset.report_id == report_id)
-    .order_by(Review.review_number.asc())
-    .offset(offset)
+@instrument('db.get_reviews')
+async def get_reviews(report_id: int, limit: int, db: AsyncSession, offset: int = 0, cursor: tuple = None,
+                      category: str = None, sentiment: str = None):
+  """
+    Returns a page of the reviews of a report ordered by (dataset_id, review_number).
+    With a cursor, the page starts right after that key instead of skipping `offset` rows,
+    so every page costs the same as the first one
+  """
+  query = _review_rows_query(report_id)
+  if category is not None:
+    query = query.filter(or_(
+      exists().where(review_categories.c.review_id == Review.id,
+                     review_categories.c.category_id == DB_CATEGORY_CODES[category]),
+      _category_mask_filter(category)
+    ))
+  if sentiment is not None:
+    score_column = CATEGORY_SCORE_COLUMNS[category] if category is not None else Review.prediction
+    query = query.filter(score_column == DB_SENTIMENT_VALUES[sentiment])
+  if cursor is not None:
+    query = query.filter(tuple_(Review.dataset_id, Review.review_number) > tuple_(*cursor))
+  else:
+    query = query.offset(offset)
+
+  result = await db.execute(
+    query
+    .order_by(Review.dataset_id.asc(), Review.review_number.asc())
     .limit(limit)
-    .all()
   )
+  reviews = result.all()
   return reviews
 
-def get_word_count(report_id: int, db: SessionLocal):
-  report = db.query(Report).filter_by(id=report_id).first()
-  if report is None:
-    return {'error': f'Report with id={report_id} not found'}
-  word_count = json.loads(report.word_count)
-  return {'word_count': word_count}
+def _review_rows_query(report_id: int):
+  """
+    Column-only query of the reviews of a report. Compact rows carry their category mask,
+    the others the ids of their linked categories
+  """
+  linked_categories = (
+    select(func.array_agg(review_categories.c.category_id))
+    .where(review_categories.c.review_id == Review.id)
+    .scalar_subquery()
+  )
+  return (
+    select(Review.id, Review.dataset_id, Review.review_number,
+           func.coalesce(ReviewText.text, Review.review_text).label('review_text'),
+           Review.prediction, Review.fit_score, Review.color_score, Review.quality_score, Review.category_mask,
+           case((Review.category_mask.is_(None), linked_categories), else_=None).label('category_ids'))
+    .join(Dataset)
+    .outerjoin(ReviewText, Review.text_id == ReviewText.id)
+    .filter(Dataset.report_id == report_id)
+  )
+
+async def stream_review_rows(report_id: int, db: AsyncSession, batch_size: int = DB_BULK_BATCH_SIZE):
+  """
+    Yields every review of a report in batches of plain rows through a server-side cursor
+  """
+  query = (
+    _review_rows_query(report_id)
+    .order_by(Review.dataset_id.asc(), Review.review_number.asc())
+    .execution_options(yield_per=batch_size)
+  )
+  result = await db.stream(query)
+  async for rows in result.partitions():
+    yield rows
 
-def get_wordcloud(report_id: int, db: SessionLocal):
-  report = db.query(Report).filter_by(id=report_id).first()
+def _category_mask_filter(category: str):
+  # Only matches compact rows, the others have a NULL mask
+  if category == 'OTHER':
+    return Review.category_mask == 0
+  return Review.category_mask.op('&')(DB_CATEGORY_BITS[category]) != 0
+
+async def decode_reviews(reviews: list, db: AsyncSession):
+  category_names = await review_storage.get_category_names(db)
+  return [review_storage.review_response(review, category_names) for review in reviews]
+
+def encode_review_cursor(review):
+  return f"{review.dataset_id}.{review.review_number}"
+
+def decode_review_cursor(cursor: str):
+  dataset_id, review_number = cursor.split('.')
+  return int(dataset_id), int(review_number)
+
+@instrument('db.get_word_count')
+async def get_word_count(report_id: int, db: AsyncSession, top: int = WORD_COUNT_DEFAULT_TOP,
+                         category: str = None, sentiment: str = None):
+  """
+    Returns the most frequent words of a report, optionally within a category and/or sentiment.
+    The top words are picked by the database from the stored frequency table
+  """
+  key = breakdown_key(category, sentiment)
+  result = await db.execute(
+    select(Report.word_count, Report.word_frequencies.is_not(None).label('has_frequencies'),
+           Report.word_statistics.has_key(key).label('has_breakdown'))
+    .filter_by(id=report_id)
+  )
+  report = result.first()
   if report is None:
     return {'error': f'Report with id={report_id} not found'}
-  wordcloud_b64 = b64encode(report.wordcloud).decode('utf-8')
-  return {'wordcloud': wordcloud_b64}
-  
-def delete_collection(collection_id: int, db: SessionLocal):
-  collection = db.query(ReportGroup).filter(ReportGroup.id == collection_id).first()
+  if not report.has_frequencies:
+    # Reports created before the word frequencies were stored only have their top words
+    if key != ALL_WORDS or top > WORD_COUNT_DEFAULT_TOP:
+      return {'error': f'Word statistics are not available for report with id={report_id}'}
+    # They were stored most frequent first
+    word_count = json.loads(report.word_count)
+    return {'word_count': dict(list(word_count.items())[:top])}
+  if key != ALL_WORDS:
+    if report.has_breakdown is None:
+      return {'error': f'Word statistics by category and sentiment are not available for report with id={report_id}'}
+    if not report.has_breakdown:
+      # None of the reviews of the report falls in that breakdown
+      return {'word_count': {}}
+
+  frequencies = Report.word_frequencies if key == ALL_WORDS else Report.word_statistics[key]
+  words = func.jsonb_each_text(frequencies).table_valued('key', 'value')
+  count = words.c.value.cast(Integer)
+  result = await db.execute(
+    select(words.c.key, count)
+    .select_from(Report)
+    .join(words, true())
+    .filter(Report.id == report_id)
+    .order_by(count.desc(), words.c.key.asc())
+    .limit(top)
+  )
+  return {'word_count': {word: {'count': word_count} for word, word_count in result}}
+
+@instrument('db.delete_collection')
+async def delete_collection(collection_id: int, db: AsyncSession):
+  collection = await db.get(ReportGroup, collection_id)
   if not collection:
     return None
-  db.delete(collection)
-  db.commit()
+  await rollups.delete_collection_rollup(collection_id, db)
+  await db.delete(collection)
+  await db.commit()
   return collection
 
-def delete_report(report_id: int, db: SessionLocal):
-  report = db.query(Report).filter(Report.id == report_id).first()
+@instrument('db.delete_report')
+async def delete_report(report_id: int, db: AsyncSession):
+  report = await db.get(Report, report_id, options=[defer(Report.wordcloud), defer(Report.word_frequencies), defer(Report.word_statistics)])
   if not report:
     return None
-  db.delete(report)
-  db.commit()
-  return report
\ No newline at end of file
+  await rollups.apply_rollups_async(report, rollups.report_rollup_values(report, sign=-1), db)
+  await db.delete(report)
+  await db.commit()
+  return report
@@ -0,0 +1,110 @@
+import csv
+import io
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy.ext.asyncio import AsyncSession
+from services import dashboard_service as dashboard
+from services import review_storage_service as review_storage
+
+EXPORT_FORMATS = {
+  'csv': 'text/csv',
+  'ndjson': 'application/x-ndjson',
+  'parquet': 'application/vnd.apache.parquet'
+}
+EXPORT_COLUMNS = ['review_number', 'review_text', 'prediction', 'fit_score', 'color_score', 'quality_score', 'categories']
+# Separator of the categories of a review within a CSV cell
+CSV_CATEGORY_SEPARATOR = '|'
+
+def export_record(row, category_names: dict):
+  category_ids = review_storage.review_category_ids(row)
+  return {
+    "review_number": row.review_number,
+    "review_text": row.review_text,
+    "prediction": row.prediction,
+    "fit_score": review_storage.score_value(row.fit_score),
+    "color_score": review_storage.score_value(row.color_score),
+    "quality_score": review_storage.score_value(row.quality_score),
+    "categories": [category_names.get(category_id, str(category_id)) for category_id in category_ids],
+  }
+
+async def _records(report_id: int, db: AsyncSession):
+  category_names = await review_storage.get_category_names(db)
+  async for rows in dashboard.stream_review_rows(report_id=report_id, db=db):
+    yield [export_record(row, category_names) for row in rows]
+
+async def _csv(report_id: int, db: AsyncSession):
+  buffer = io.StringIO()
+  writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+  writer.writeheader()
+  async for records in _records(report_id, db):
+    for record in records:
+      record['categories'] = CSV_CATEGORY_SEPARATOR.join(record['categories'])
+      writer.writerow(record)
+    yield buffer.getvalue().encode('utf-8')
+    buffer.seek(0)
+    buffer.truncate()
+  if buffer.tell():
+    yield buffer.getvalue().encode('utf-8')
+
+async def _ndjson(report_id: int, db: AsyncSession):
+  async for records in _records(report_id, db):
+    yield ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+
+class _ChunkSink(io.RawIOBase):
+  """
+    Write-only file that hands out what was written since the last call, while reporting
+    the total position the Parquet writer needs for its footer
+  """
+  def __init__(self):
+    self._chunks = []
+    self._position = 0
+
+  def writable(self):
+    return True
+
+  def write(self, data):
+    self._chunks.append(bytes(data))
+    self._position += len(data)
+    return len(data)
+
+  def tell(self):
+    return self._position
+
+  def take(self):
+    data = b''.join(self._chunks)
+    self._chunks = []
+    return data
+
+async def _parquet(report_id: int, db: AsyncSession):
+  schema = pa.schema([
+    ('review_number', pa.int64()),
+    ('review_text', pa.string()),
+    ('prediction', pa.int16()),
+    ('fit_score', pa.int16()),
+    ('color_score', pa.int16()),
+    ('quality_score', pa.int16()),
+    ('categories', pa.list_(pa.string())),
+  ])
+  sink = _ChunkSink()
+  writer = pq.ParquetWriter(sink, schema)
+  try:
+    # Every batch of the cursor becomes a row group, flushed to the client right away
+    async for records in _records(report_id, db):
+      writer.write_table(pa.Table.from_pylist(records, schema=schema))
+      yield sink.take()
+  finally:
+    writer.close()
+  yield sink.take()
+
+EXPORTERS = {
+  'csv': _csv,
+  'ndjson': _ndjson,
+  'parquet': _parquet
+}
+
+def export_reviews(report_id: int, export_format: str, db: AsyncSession):
+  """
+    Returns an async iterator over the bytes of every review of a report in the given format
+  """
+  return EXPORTERS[export_format](report_id, db)
@@ -0,0 +1,318 @@
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+import json
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from fastapi import UploadFile
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import database
+from database.database import SessionLocal
+from schemas.job import Job, JOB_KINDS, JOB_STATUS
+from schemas.user import User
+from sentiment_analysis import engine
+from sentiment_analysis.result_cache import result_cache, cache_key, wordcloud_key, RESULT_CACHE_ENABLED, RESULT_CACHE_MAX_FILE_BYTES
+from services import dashboard_service as dashboard
+from services import wordcloud_service as wordclouds
+
+logger = logging.getLogger(__name__)
+
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", 2))
+JOB_UPLOAD_DIR = os.getenv("JOB_UPLOAD_DIR", tempfile.gettempdir())
+JOB_STREAMING_MIN_BYTES = int(os.getenv("JOB_STREAMING_MIN_BYTES", 20 * 1024 * 1024))
+
+_executor = None
+
+def _init_worker():
+  # Pooled connections inherited from the API process must not be shared with the worker
+  database.engine.dispose(close=False)
+
+def get_executor():
+  global _executor
+  if _executor is None:
+    _executor = ProcessPoolExecutor(max_workers=REPORT_WORKERS, initializer=_init_worker)
+  return _executor
+
+def shutdown_executor():
+  global _executor
+  if _executor is not None:
+    _executor.shutdown(wait=False, cancel_futures=True)
+    _executor = None
+
+def spool_upload(file: UploadFile):
+  """
+    Copies the uploaded CSV to a file the worker processes can read
+  """
+  fd, upload_path = tempfile.mkstemp(suffix='.csv', dir=JOB_UPLOAD_DIR)
+  with os.fdopen(fd, 'wb') as upload:
+    shutil.copyfileobj(file.file, upload)
+  return upload_path
+
+async def create_job(title: str, filename: str, collection_id: int, user: User, db: AsyncSession,
+                     kind: str = JOB_KINDS['CREATE'], report_id: int = None):
+  job_create_data = Job.JobCreate(id=str(uuid.uuid4()), user_id=user.id, report_group_id=collection_id, title=title,
+                                  filename=filename, kind=kind, report_id=report_id)
+  db_job = Job(**job_create_data.dict(), status=JOB_STATUS['PENDING'], progress=0.0, created_at=datetime.now(), updated_at=datetime.now())
+  db.add(db_job)
+  await db.commit()
+  await db.refresh(db_job)
+  return db_job
+
+async def get_job(job_id: str, db: AsyncSession):
+  return await db.get(Job, job_id)
+
+def update_job(job_id: str, db: SessionLocal, **values):
+  values['updated_at'] = datetime.now()
+  db.query(Job).filter_by(id=job_id).update(values)
+  db.commit()
+
+def _submit(job: Job, upload_path: str):
+  if job.kind == JOB_KINDS['APPEND']:
+    return get_executor().submit(run_append_job, job.id, upload_path, job.filename, job.report_id)
+  return get_executor().submit(run_report_job, job.id, upload_path, job.filename, job.title, job.user_id, job.report_group_id)
+
+def submit_report_job(job: Job, upload_path: str):
+  try:
+    future = _submit(job, upload_path)
+  except BrokenProcessPool:
+    # A worker that died, e.g. killed for running out of memory, breaks the whole pool for good
+    logger.warning("Report worker pool is broken, starting a new one")
+    shutdown_executor()
+    try:
+      future = _submit(job, upload_path)
+    except BrokenProcessPool as error:
+      _fail_job(job.id, upload_path, str(error))
+      raise
+  future.add_done_callback(lambda future: _on_job_done(job.id, upload_path, future))
+  return future
+
+def run_report_job(job_id: str, upload_path: str, filename: str, title: str, user_id: int, collection_id: int):
+  """
+    Runs the report pipeline inside a worker process and records its progress on the job
+  """
+  db = SessionLocal()
+  try:
+    update_job(job_id, db, status=JOB_STATUS['RUNNING'], stage='predict', progress=0.1)
+    file_size = os.path.getsize(upload_path)
+    results_key = _results_key(upload_path) if RESULT_CACHE_ENABLED and file_size <= RESULT_CACHE_MAX_FILE_BYTES else None
+    if file_size >= JOB_STREAMING_MIN_BYTES:
+      report = _run_streaming_pipeline(job_id, upload_path, filename, title, user_id, collection_id, db)
+    else:
+      report = _run_pipeline(job_id, upload_path, filename, title, user_id, collection_id, db, results_key=results_key)
+
+    update_job(job_id, db, status=JOB_STATUS['COMPLETED'], stage=None, progress=1.0, report_id=report.id)
+    _prerender_wordcloud(report.id, db, results_key=results_key)
+    return report.id
+  except Exception as error:
+    db.rollback()
+    update_job(job_id, db, status=JOB_STATUS['FAILED'], error=str(error))
+    raise
+  finally:
+    db.close()
+    os.remove(upload_path)
+
+def run_append_job(job_id: str, upload_path: str, filename: str, report_id: int):
+  """
+    Scores only the uploaded reviews inside a worker process and folds them into the
+    stored aggregates of an existing report, without touching its previous reviews
+  """
+  db = SessionLocal()
+  dataset = None
+  try:
+    update_job(job_id, db, status=JOB_STATUS['RUNNING'], stage='predict', progress=0.1)
+    report = dashboard.get_report_for_update(report_id=report_id, db=db)
+    if report is None:
+      raise ValueError(f'Report with id={report_id} not found')
+    word_frequencies = report.word_frequencies
+    db.commit()
+    if word_frequencies is None:
+      word_frequencies = _count_stored_words(report_id, db)
+
+    metadata = {"dataset_title": filename}
+    dataset = dashboard.save_dataset(report=report, report_metadata=metadata, db=db)
+    aggregates = engine.ReportAggregates()
+    file_size = os.path.getsize(upload_path)
+    with open(upload_path, 'rb') as file:
+      reserve = lambda count: dashboard.reserve_review_numbers(report_id=report_id, count=count, db=db)
+      for reviews in engine.predict_csv_chunks(file, aggregates, reserve_review_numbers=reserve):
+        dashboard.save_reviews_bulk(dataset=dataset, reviews_list=reviews, db=db)
+        update_job(job_id, db, stage='predict', progress=0.1 + 0.8 * file.tell() / file_size)
+
+    update_job(job_id, db, stage='save_report', progress=0.9)
+    # Locked until the commit so concurrent appends to the same report do not lose updates
+    report = dashboard.get_report_for_update(report_id=report_id, db=db)
+    if report.word_frequencies is not None:
+      word_frequencies = report.word_frequencies
+    report_aggregates = engine.ReportAggregates.from_report(report, word_frequencies)
+    report_aggregates.merge(aggregates)
+    wordclouds.delete_wordcloud_images(report_id=report_id, db=db)
+    dashboard.update_report_aggregates(report=report, aggregates=report_aggregates, db=db)
+
+    update_job(job_id, db, status=JOB_STATUS['COMPLETED'], stage=None, progress=1.0)
+    _prerender_wordcloud(report_id, db)
+    return report_id
+  except Exception as error:
+    db.rollback()
+    if dataset is not None:
+      # Reviews are committed chunk by chunk, they must not stay in a report whose totals exclude them
+      dashboard.delete_dataset(dataset_id=dataset.id, db=db)
+    update_job(job_id, db, status=JOB_STATUS['FAILED'], error=str(error))
+    raise
+  finally:
+    db.close()
+    os.remove(upload_path)
+
+def _count_stored_words(report_id: int, db: SessionLocal):
+  # Reports created before the full word frequencies were stored only kept the top words,
+  # so their frequencies are counted once from the stored reviews
+  word_counter = Counter()
+  for texts in dashboard.get_review_texts(report_id=report_id, db=db):
+    word_counter.update(engine.count_words(texts))
+  return dict(word_counter)
+
+def _report_data(title: str, user_id: int, collection_id: int, results: dict, word_count: dict, word_frequencies: dict,
+                 word_statistics: dict):
+  report_data = {
+    "title": title,
+    "user_id": user_id,
+    "report_group_id": collection_id,
+    "date": datetime.now(),
+    **results['scores'],
+    **results['number_of_reviews'],
+    "word_count": json.dumps(word_count),
+    "word_frequencies": word_frequencies,
+    "word_statistics": word_statistics,
+  }
+  return report_data
+
+def _results_key(upload_path: str):
+  # The cache only saves work, a failure to address it must not fail the job
+  try:
+    return cache_key(upload_path)
+  except Exception:
+    logger.exception("Could not compute the result cache key of %s", upload_path)
+    return None
+
+def _cache_results(key: str, entry):
+  try:
+    result_cache.put(key, entry)
+  except Exception:
+    logger.exception("Could not cache the results of %s", key)
+
+def _run_pipeline(job_id: str, upload_path: str, filename: str, title: str, user_id: int, collection_id: int, db: SessionLocal,
+                  results_key: str = None):
+  """
+    Scores the whole upload at once. Identical files scored by the same models reuse the
+    cached predictions, reviews and word counts
+  """
+  entry = result_cache.get(results_key) if results_key is not None else None
+  if entry is None:
+    with open(upload_path, 'rb') as file:
+      results, _, reviews, word_count, word_frequencies, word_statistics = engine.predict_csv(file, filename)
+    entry = {
+      "predictions": results,
+      "reviews": reviews,
+      "word_count": word_count,
+      "word_frequencies": word_frequencies,
+      "word_statistics": word_statistics,
+    }
+    if results_key is not None:
+      _cache_results(results_key, entry)
+  else:
+    logger.info("Reusing the cached results of job %s", job_id)
+  results, reviews = entry['predictions'], entry['reviews']
+  word_count, word_frequencies, word_statistics = entry['word_count'], entry['word_frequencies'], entry['word_statistics']
+  metadata = {"dataset_title": filename}
+
+  update_job(job_id, db, stage='save_report', progress=0.6)
+  report_data = _report_data(title, user_id, collection_id, results, word_count, word_frequencies, word_statistics)
+  report = dashboard.save_report(report_data=report_data, db=db)
+
+  try:
+    update_job(job_id, db, stage='save_reviews', progress=0.7)
+    dataset = dashboard.save_dataset(report=report, report_metadata=metadata, db=db)
+    dashboard.save_reviews_bulk(dataset=dataset, reviews_list=reviews, db=db)
+  except Exception:
+    # The report is committed with its totals, it must not stay listed without its reviews
+    _discard_partial_report(db, report=report)
+    raise
+  return report
+
+def _run_streaming_pipeline(job_id: str, upload_path: str, filename: str, title: str, user_id: int, collection_id: int, db: SessionLocal):
+  """
+    Scores and persists the upload chunk by chunk so memory is bounded by the chunk size.
+    The dataset is linked to its report once the aggregates are complete
+  """
+  metadata = {"dataset_title": filename}
+  dataset = dashboard.save_dataset(report=None, report_metadata=metadata, db=db)
+  report = None
+  aggregates = engine.ReportAggregates()
+  file_size = os.path.getsize(upload_path)
+
+  try:
+    with open(upload_path, 'rb') as file:
+      for reviews in engine.predict_csv_chunks(file, aggregates):
+        dashboard.save_reviews_bulk(dataset=dataset, reviews_list=reviews, db=db)
+        update_job(job_id, db, stage='predict', progress=0.1 + 0.8 * file.tell() / file_size)
+
+    update_job(job_id, db, stage='save_report', progress=0.9)
+    word_statistics = aggregates.word_statistics
+    report_data = _report_data(title, user_id, collection_id, aggregates.predictions(), aggregates.word_count(),
+                               word_statistics.frequencies(), word_statistics.breakdowns())
+    report = dashboard.save_report(report_data=report_data, db=db)
+    dashboard.attach_dataset(dataset=dataset, report=report, db=db)
+  except Exception:
+    # Reviews are committed chunk by chunk into a dataset no report links to yet
+    _discard_partial_report(db, dataset=dataset, report=report)
+    raise
+  return report
+
+def _discard_partial_report(db: SessionLocal, dataset=None, report=None):
+  # Logged rather than raised, so the job still records the error that made it fail
+  try:
+    db.rollback()
+    if dataset is not None:
+      dashboard.delete_dataset(dataset_id=dataset.id, db=db)
+    if report is not None:
+      dashboard.discard_report(report_id=report.id, db=db)
+  except Exception:
+    db.rollback()
+    logger.exception("Could not remove the partial results of a failed report job")
+
+def _prerender_wordcloud(report_id: int, db: SessionLocal, results_key: str = None):
+  # The report is already available, a failure here only means the image is drawn on its first request
+  try:
+    cached = result_cache.get(wordcloud_key(results_key)) if results_key is not None else None
+    data = wordclouds.prerender_wordcloud(report_id=report_id, db=db, data=cached)
+    if results_key is not None and cached is None and data is not None:
+      _cache_results(wordcloud_key(results_key), data)
+  except Exception:
+    db.rollback()
+    logger.exception("Could not prerender the wordcloud of report %s", report_id)
+
+def _on_job_done(job_id: str, upload_path: str, future):
+  if future.cancelled():
+    error = 'Job was cancelled'
+  elif future.exception() is not None:
+    error = str(future.exception())
+  else:
+    return
+
+  logger.error("Report job %s failed: %s", job_id, error)
+  _fail_job(job_id, upload_path, error)
+
+def _fail_job(job_id: str, upload_path: str, error: str):
+  # The worker may have died before cleaning up and recording the failure itself
+  if os.path.exists(upload_path):
+    os.remove(upload_path)
+  db = SessionLocal()
+  try:
+    job = db.query(Job).filter_by(id=job_id).first()
+    if job is not None and job.status != JOB_STATUS['FAILED']:
+      update_job(job_id, db, status=JOB_STATUS['FAILED'], error=error)
+  finally:
+    db.close()
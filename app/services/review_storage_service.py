@@ -0,0 +1,87 @@
+import hashlib
+import pandas as pd
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import SessionLocal, DB_REVIEW_STORAGE
+from schemas.category import Category
+from schemas.review_text import ReviewText
+from sentiment_analysis.categorization import categories_from_mask
+
+_category_names = None
+
+def is_compact():
+  return DB_REVIEW_STORAGE == 'compact'
+
+def text_digest(review_text: str):
+  return hashlib.sha256(review_text.encode('utf-8')).hexdigest()
+
+def save_review_texts(texts: list, db: SessionLocal):
+  """
+    Stores each distinct text once and returns the id of every given text
+  """
+  digests = {text_digest(review_text): review_text for review_text in texts}
+  rows = [{"digest": digest, "text": review_text} for digest, review_text in digests.items()]
+  insert_texts = insert(ReviewText).on_conflict_do_nothing(index_elements=['digest']).returning(ReviewText.digest, ReviewText.id)
+  text_ids = dict(db.execute(insert_texts, rows).all())
+
+  # Texts stored by earlier uploads are not returned by the insert
+  missing = [digest for digest in digests if digest not in text_ids]
+  if missing:
+    text_ids.update(db.execute(select(ReviewText.digest, ReviewText.id).filter(ReviewText.digest.in_(missing))).all())
+  return {review_text: text_ids[digest] for digest, review_text in digests.items()}
+
+def score_value(value):
+  """
+    Score of a review in a category, None for the categories it is not in. Those are
+    left empty by the models and stored as -1 by the legacy storage
+  """
+  if pd.isna(value) or value < 0:
+    return None
+  return int(value)
+
+def compact_review_row(dataset_id: int, review: dict, text_ids: dict):
+  return {
+    "dataset_id": dataset_id,
+    "review_number": int(review['reviewNumber']),
+    "text_id": text_ids[review['reviewText']],
+    "category_mask": int(review['categoryMask']),
+    "prediction": int(review['overall']),
+    "fit_score": score_value(review['fit']),
+    "color_score": score_value(review['color']),
+    "quality_score": score_value(review['quality']),
+  }
+
+async def get_category_names(db: AsyncSession):
+  global _category_names
+  if _category_names is None:
+    result = await db.execute(select(Category.id, Category.name))
+    _category_names = dict(result.all())
+  return _category_names
+
+def _sentinel(value):
+  return -1 if value is None else value
+
+def review_category_ids(row):
+  """
+    Category ids of a review row, decoded from its bitmask or read from its linked categories
+  """
+  if row.category_mask is None:
+    return row.category_ids or []
+  return categories_from_mask(row.category_mask)
+
+def review_response(row, category_names: dict):
+  """
+    Decodes a review row stored either way into the same response
+  """
+  return {
+    "id": row.id,
+    "dataset_id": row.dataset_id,
+    "review_number": row.review_number,
+    "review_text": row.review_text,
+    "prediction": row.prediction,
+    "fit_score": _sentinel(row.fit_score),
+    "color_score": _sentinel(row.color_score),
+    "quality_score": _sentinel(row.quality_score),
+    "categories": [{"id": category_id, "name": category_names.get(category_id)} for category_id in review_category_ids(row)],
+  }
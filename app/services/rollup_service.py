@@ -0,0 +1,129 @@
+from datetime import date, datetime
+import math
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import SessionLocal, DB_BULK_BATCH_SIZE
+from schemas.report import Report
+from schemas.report_rollup import CollectionRollup, UserRollup, UserDailyRollup
+
+# Category whose scores and reviews each rollup column accumulates
+ROLLUP_CATEGORIES = {
+  'overall': ('overall_score', 'total_reviews'),
+  'fit': ('fit_score', 'fit_reviews'),
+  'color': ('color_score', 'color_reviews'),
+  'quality': ('quality_score', 'quality_reviews')
+}
+ROLLUP_COLUMNS = ['report_count', 'total_reviews', 'fit_reviews', 'color_reviews', 'quality_reviews',
+                  'overall_score_sum', 'fit_score_sum', 'color_score_sum', 'quality_score_sum']
+
+def _report_day(report: Report):
+  if isinstance(report.date, datetime):
+    return report.date.date()
+  return report.date
+
+def report_rollup_values(report: Report, sign: int = 1):
+  """
+    Contribution of a report to the rollups it belongs to, negated with sign=-1 to remove it
+  """
+  values = {'report_count': sign}
+  for score_column, reviews_column in ROLLUP_CATEGORIES.values():
+    reviews = getattr(report, reviews_column) or 0
+    score = getattr(report, score_column)
+    values[reviews_column] = sign * reviews
+    # Categories without reviews have a NaN score and add nothing
+    values[score_column + '_sum'] = sign * score * reviews if reviews and score is not None and not math.isnan(score) else 0.0
+  return values
+
+def subtract_rollup_values(values: dict, previous: dict):
+  return {column: values[column] - previous[column] for column in ROLLUP_COLUMNS}
+
+def _upsert(model, keys: dict, values: dict):
+  statement = insert(model).values(**keys, **values)
+  return statement.on_conflict_do_update(
+    index_elements=list(keys),
+    set_={column: getattr(model, column) + statement.excluded[column] for column in values}
+  )
+
+def rollup_statements(report: Report, values: dict):
+  """
+    Upserts that add the given values to every rollup the report belongs to
+  """
+  statements = [
+    _upsert(UserRollup, {'user_id': report.user_id}, values),
+    _upsert(UserDailyRollup, {'user_id': report.user_id, 'day': _report_day(report)}, values),
+  ]
+  if report.report_group_id is not None:
+    statements.append(_upsert(CollectionRollup, {'report_group_id': report.report_group_id}, values))
+  return statements
+
+def apply_rollups(report: Report, values: dict, db: SessionLocal):
+  """
+    Updates the rollups within the caller's transaction
+  """
+  for statement in rollup_statements(report, values):
+    db.execute(statement)
+
+async def apply_rollups_async(report: Report, values: dict, db: AsyncSession):
+  for statement in rollup_statements(report, values):
+    await db.execute(statement)
+
+def rollup_summary(rollup):
+  """
+    Review-weighted averages and category counts of a rollup row
+  """
+  if rollup is None:
+    return {'report_count': 0, 'total_reviews': 0, 'scores': {}, 'number_of_reviews': {}}
+  scores = {}
+  number_of_reviews = {}
+  for score_column, reviews_column in ROLLUP_CATEGORIES.values():
+    reviews = getattr(rollup, reviews_column)
+    number_of_reviews[reviews_column] = reviews
+    scores[score_column] = getattr(rollup, score_column + '_sum') / reviews if reviews else None
+  return {
+    'report_count': rollup.report_count,
+    'total_reviews': rollup.total_reviews,
+    'scores': scores,
+    'number_of_reviews': number_of_reviews
+  }
+
+async def get_collection_rollup(collection_id: int, db: AsyncSession):
+  rollup = await db.get(CollectionRollup, collection_id)
+  return rollup_summary(rollup)
+
+async def get_user_rollup(user_id: int, db: AsyncSession):
+  rollup = await db.get(UserRollup, user_id)
+  return rollup_summary(rollup)
+
+async def get_user_daily_rollups(user_id: int, db: AsyncSession, start: date = None, end: date = None):
+  query = select(UserDailyRollup).filter(UserDailyRollup.user_id == user_id, UserDailyRollup.report_count > 0)
+  if start is not None:
+    query = query.filter(UserDailyRollup.day >= start)
+  if end is not None:
+    query = query.filter(UserDailyRollup.day <= end)
+  result = await db.execute(query.order_by(UserDailyRollup.day.asc()))
+  return [{'day': rollup.day, **rollup_summary(rollup)} for rollup in result.scalars()]
+
+async def delete_collection_rollup(collection_id: int, db: AsyncSession):
+  await db.execute(delete(CollectionRollup).filter_by(report_group_id=collection_id))
+
+def rebuild_rollups(db: SessionLocal):
+  """
+    Recomputes every rollup from the stored reports, for databases that had reports
+    before the rollups were maintained
+  """
+  db.execute(delete(CollectionRollup))
+  db.execute(delete(UserRollup))
+  db.execute(delete(UserDailyRollup))
+  columns = [getattr(Report, column) for pair in ROLLUP_CATEGORIES.values() for column in pair]
+  reports = db.query(Report.user_id, Report.report_group_id, Report.date, *columns).yield_per(DB_BULK_BATCH_SIZE)
+  for report in reports:
+    apply_rollups(report, report_rollup_values(report), db)
+  db.commit()
+
+if __name__ == '__main__':
+  db = SessionLocal()
+  try:
+    rebuild_rollups(db)
+  finally:
+    db.close()
@@ -0,0 +1,121 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import pandas as pd
+from database.database import DB_CATEGORY_BITS
+from monitoring.metrics import timed
+from sentiment_analysis import engine
+from services.review_storage_service import score_value
+
+SCORING_BATCH_SIZE = int(os.getenv("SCORING_BATCH_SIZE", 256))
+SCORING_MAX_WAIT_SECONDS = float(os.getenv("SCORING_MAX_WAIT_MS", 10)) / 1000
+SCORING_MAX_REVIEWS = int(os.getenv("SCORING_MAX_REVIEWS", 1000))
+SCORING_WORKERS = int(os.getenv("SCORING_WORKERS", 1))
+
+# Scoring is CPU bound, so batches run here instead of on the event loop
+_scoring_executor = ThreadPoolExecutor(max_workers=SCORING_WORKERS, thread_name_prefix="scoring")
+
+def score_reviews(texts: list):
+  """
+    Preprocesses, classifies and scores a batch of raw reviews without storing anything
+  """
+  with timed('scoring.batch'):
+    df = engine.process_reviews(pd.Series(texts, dtype=object).fillna(''))
+  results = []
+  for mask, overall, fit, color, quality in zip(df['categoryMask'], df['overall'], df['fit'], df['color'], df['quality']):
+    categories = [category for category, bit in DB_CATEGORY_BITS.items() if mask & bit] or ['OTHER']
+    results.append({
+      "categories": categories,
+      "overall": score_value(overall),
+      "fit": score_value(fit),
+      "color": score_value(color),
+      "quality": score_value(quality),
+    })
+  return results
+
+class ReviewBatcher:
+  """
+    Coalesces the reviews of concurrent requests into shared micro-batches. A batch is
+    scored once it holds batch_size reviews or its first review waited max_wait seconds
+  """
+  def __init__(self, batch_size: int = SCORING_BATCH_SIZE, max_wait: float = SCORING_MAX_WAIT_SECONDS,
+               workers: int = SCORING_WORKERS):
+    self.batch_size = batch_size
+    self.max_wait = max_wait
+    self.workers = workers
+    self._queue = None
+    self._task = None
+    self._batches = set()
+
+  def _start(self):
+    if self._task is None or self._task.done():
+      self._queue = asyncio.Queue()
+      self._task = asyncio.get_running_loop().create_task(self._run())
+
+  def submit(self, texts: list):
+    """
+      Queues the reviews and returns a future per review, resolved with its result
+    """
+    self._start()
+    loop = asyncio.get_running_loop()
+    futures = []
+    for text in texts:
+      future = loop.create_future()
+      self._queue.put_nowait((text, future))
+      futures.append(future)
+    return futures
+
+  async def _next_batch(self):
+    batch = [await self._queue.get()]
+    deadline = asyncio.get_running_loop().time() + self.max_wait
+    while len(batch) < self.batch_size:
+      timeout = deadline - asyncio.get_running_loop().time()
+      if timeout <= 0:
+        break
+      try:
+        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+      except asyncio.TimeoutError:
+        break
+    return batch
+
+  async def _run(self):
+    loop = asyncio.get_running_loop()
+    # A batch is only formed once a scoring thread is free, reviews keep queueing meanwhile
+    workers = asyncio.Semaphore(self.workers)
+    while True:
+      await workers.acquire()
+      batch = await self._next_batch()
+      # Requests that went away meanwhile do not need their reviews scored
+      batch = [(text, future) for text, future in batch if not future.cancelled()]
+      if not batch:
+        workers.release()
+        continue
+      task = loop.create_task(self._score_batch(batch, workers))
+      self._batches.add(task)
+      task.add_done_callback(self._batches.discard)
+
+  async def _score_batch(self, batch: list, workers: asyncio.Semaphore):
+    try:
+      results = await asyncio.get_running_loop().run_in_executor(_scoring_executor, score_reviews, [text for text, _ in batch])
+    except Exception as error:
+      for _, future in batch:
+        if not future.done():
+          future.set_exception(error)
+      return
+    finally:
+      workers.release()
+    for (_, future), result in zip(batch, results):
+      if not future.done():
+        future.set_result(result)
+
+  async def close(self):
+    if self._task is not None:
+      self._task.cancel()
+      self._task = None
+    for task in list(self._batches):
+      task.cancel()
+
+batcher = ReviewBatcher()
+
+def shutdown_executor():
+  _scoring_executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,126 @@
+from datetime import datetime
+import hashlib
+from io import BytesIO
+import os
+from PIL import Image
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from database.database import SessionLocal
+from schemas.report import Report
+from schemas.wordcloud_image import WordcloudImage
+from sentiment_analysis import engine
+
+WORDCLOUD_DEFAULT_WIDTH = 800
+WORDCLOUD_DEFAULT_HEIGHT = 400
+WORDCLOUD_FORMATS = {
+  'png': 'image/png',
+  'webp': 'image/webp'
+}
+# Requested sizes are rounded up to these, so each report has a bounded number of cached variants
+WORDCLOUD_DIMENSIONS = (200, 400, 800, 1200, 1600, 2000)
+# Browsers revalidate on every load, so an appended report shows its new image while unchanged ones get a 304
+WORDCLOUD_CACHE_CONTROL = os.getenv("WORDCLOUD_CACHE_CONTROL", "private, no-cache")
+
+def snap_dimension(size: int):
+  """
+    Smallest allowed dimension that is at least the requested one
+  """
+  return next((dimension for dimension in WORDCLOUD_DIMENSIONS if dimension >= size), WORDCLOUD_DIMENSIONS[-1])
+
+def image_etag(data: bytes):
+  return hashlib.sha256(data).hexdigest()
+
+def _variant_filter(report_id: int, width: int, height: int, image_format: str):
+  return {'report_id': report_id, 'width': width, 'height': height, 'format': image_format}
+
+def _insert_wordcloud_image(report_id: int, width: int, height: int, image_format: str, data: bytes):
+  # Concurrent requests may render the same variant, the first one stored wins
+  return (
+    insert(WordcloudImage)
+    .values(report_id=report_id, width=width, height=height, format=image_format, data=data, etag=image_etag(data), created_at=datetime.now())
+    .on_conflict_do_nothing(constraint='unique_wordcloud_variant')
+  )
+
+async def get_cached_wordcloud_image(report_id: int, width: int, height: int, image_format: str, db: AsyncSession):
+  result = await db.execute(
+    select(WordcloudImage.data, WordcloudImage.etag)
+    .filter_by(**_variant_filter(report_id, width, height, image_format))
+  )
+  return result.first()
+
+async def get_wordcloud_etag(report_id: int, width: int, height: int, image_format: str, db: AsyncSession):
+  """
+    Returns the ETag of a cached variant without loading the image itself
+  """
+  width, height = snap_dimension(width), snap_dimension(height)
+  result = await db.execute(
+    select(WordcloudImage.etag)
+    .filter_by(**_variant_filter(report_id, width, height, image_format))
+  )
+  return result.scalar()
+
+async def save_wordcloud_image(report_id: int, width: int, height: int, image_format: str, data: bytes, db: AsyncSession):
+  await db.execute(_insert_wordcloud_image(report_id, width, height, image_format, data))
+  await db.commit()
+
+def _convert_image(data: bytes, image_format: str):
+  image_file = BytesIO()
+  Image.open(BytesIO(data)).save(image_file, format=image_format)
+  return image_file.getvalue()
+
+async def get_wordcloud_variant(report_id: int, db: AsyncSession, width: int = WORDCLOUD_DEFAULT_WIDTH,
+                                height: int = WORDCLOUD_DEFAULT_HEIGHT, image_format: str = 'png'):
+  """
+    Returns the image and ETag of the wordcloud of a report at the requested size, rounded up to an allowed one, and format,
+    rendering it from the stored word frequencies and caching it the first time that variant is requested
+  """
+  width, height = snap_dimension(width), snap_dimension(height)
+  image = await get_cached_wordcloud_image(report_id, width, height, image_format, db)
+  if image is not None:
+    return image.data, image.etag
+
+  report = (await db.execute(select(Report.word_frequencies).filter_by(id=report_id))).first()
+  if report is None:
+    return None
+  if report.word_frequencies is None:
+    # Reports created before the word frequencies were stored only have the default PNG image,
+    # which is served at its own size and converted when another format is requested
+    wordcloud = (await db.execute(select(Report.wordcloud).filter_by(id=report_id))).scalar()
+    if image_format != 'png':
+      wordcloud = await run_in_threadpool(_convert_image, wordcloud, image_format)
+    return wordcloud, image_etag(wordcloud)
+  if not report.word_frequencies:
+    # Uploads whose reviews lost every word in the cleaning have nothing to draw
+    data = engine.render_blank_image(width=width, height=height, image_format=image_format)
+    return data, image_etag(data)
+
+  data = await run_in_threadpool(engine.render_wordcloud, report.word_frequencies, width=width, height=height, image_format=image_format)
+  await save_wordcloud_image(report_id, width, height, image_format, data, db)
+  return data, image_etag(data)
+
+async def get_wordcloud_image(report_id: int, db: AsyncSession, width: int = WORDCLOUD_DEFAULT_WIDTH,
+                              height: int = WORDCLOUD_DEFAULT_HEIGHT, image_format: str = 'png'):
+  variant = await get_wordcloud_variant(report_id, db, width=width, height=height, image_format=image_format)
+  return variant[0] if variant is not None else None
+
+def prerender_wordcloud(report_id: int, db: SessionLocal, data: bytes = None):
+  """
+    Renders and caches the default variant from a worker process, or stores the given image
+    as that variant. Returns the stored image
+  """
+  if data is None:
+    report = db.query(Report.word_frequencies).filter_by(id=report_id).first()
+    if report is None or not report.word_frequencies:
+      return None
+    data = engine.render_wordcloud(report.word_frequencies, width=WORDCLOUD_DEFAULT_WIDTH, height=WORDCLOUD_DEFAULT_HEIGHT)
+  db.execute(_insert_wordcloud_image(report_id, WORDCLOUD_DEFAULT_WIDTH, WORDCLOUD_DEFAULT_HEIGHT, 'png', data))
+  db.commit()
+  return data
+
+def delete_wordcloud_images(report_id: int, db: SessionLocal):
+  """
+    Drops the cached variants of a report whose word frequencies changed, within the caller's transaction
+  """
+  db.execute(delete(WordcloudImage).filter_by(report_id=report_id))